@@ -38,6 +38,54 @@ import codecs
 import json
 import sqlite3
 import urllib
+import hashlib
+import math
+import bz2
+import gzip
+import multiprocessing
+import pickle
+import types
+import random
+import heapq
+import threading
+import Queue
+import shutil
+import itertools
+import struct
+import sys
+import mmap
+import tempfile
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import partial
+from operator import itemgetter
+from xml.parsers import expat
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import resource
+except ImportError:
+    resource = None # no getrusage() on Windows
 
 
 # In[3]:
@@ -46,21 +94,516 @@ import urllib
 # for data cleaning and basic analysis.
 osm_file = "C:\Users\FA279J\Documents\Python\irving.osm" 
 sample_file = "sample_osm"
-def count_tags(osm_file):
-    tags = {}
-    for event, elem in ET.iterparse(osm_file):
-        if elem.tag not in tags:
-            tags[elem.tag] = 1
+
+# ================================================== #
+#               Compressed Input                     #
+# ================================================== #
+"""
+Region extracts are usually shipped compressed. osm_input() turns a file
+name ending in .bz2, .gz or .xz into a file object that decompresses as it
+is read, so every reader below takes compressed files as they are, without
+unpacking them to disk first.
+
+bzip2 files made by pbzip2/lbzip2 hold many independent streams. Those are
+found by their 'BZh?1AY&SY' start marker and decompressed in a process pool,
+a few at a time, and read back in file order. A file holding a single
+stream is decompressed serially.
+"""
+BZ2_BLOCK = 1024 * 1024
+BZ2_STREAM_START = re.compile(r'BZh[1-9]1AY&SY')
+BZ2_WINDOW = 2
+
+class ChunkReader(object):
+    """File-like object over an iterator of byte strings, so iterparse can read it"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.offset = 0
+
+    def read(self, size=-1):
+        # keep a read offset rather than re-slicing what is left of a large chunk
+        while size < 0 or len(self.buffer) - self.offset < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer = self.buffer[self.offset:] + chunk
+            self.offset = 0
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+def osm_compression(osm_file):
+    """'bz2', 'gz' or 'xz' if osm_file names a compressed file, else None"""
+    if isinstance(osm_file, basestring):
+        extension = os.path.splitext(osm_file)[1][1:]
+        if extension in ('bz2', 'gz', 'xz'):
+            return extension
+    return None
+
+
+def osm_input(osm_file, processes=1):
+    """What to hand to a parser for osm_file: plain files and file objects
+    pass through, compressed files come back as a decompressing file object"""
+    compression = osm_compression(osm_file)
+    if compression == 'bz2':
+        if processes > 1:
+            return ChunkReader(bz2_parallel_chunks(osm_file, processes))
+        return ChunkReader(bz2_chunks(osm_file))
+    elif compression == 'gz':
+        return gzip.open(osm_file, 'rb')
+    elif compression == 'xz':
+        if lzma is None:
+            raise ImportError("reading .xz files needs the lzma module (backports.lzma on Python 2)")
+        return lzma.open(osm_file, 'rb')
+    return osm_file
+
+
+def bz2_chunks(osm_file, start=0, end=None):
+    """Yield the decompressed data of every bzip2 stream in the byte range [start, end)"""
+    decompressor = bz2.BZ2Decompressor()
+    with open(osm_file, 'rb') as f:
+        f.seek(start)
+        remaining = end - start if end is not None else None
+        while remaining is None or remaining > 0:
+            block = f.read(BZ2_BLOCK if remaining is None else min(BZ2_BLOCK, remaining))
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            while block:
+                try:
+                    data = decompressor.decompress(block)
+                except EOFError:
+                    # the last stream ended exactly where the previous block did
+                    decompressor = bz2.BZ2Decompressor()
+                    continue
+                if data:
+                    yield data
+                block = decompressor.unused_data
+                if block:
+                    decompressor = bz2.BZ2Decompressor()
+
+
+def bz2_segments(osm_file):
+    """Split osm_file at bzip2 stream starts into (start, end) ranges of about BZ2_BLOCK"""
+    starts = [0]
+    offset = 0
+    tail = ''
+    with open(osm_file, 'rb') as f:
+        for block in iter(lambda: f.read(BZ2_BLOCK), ''):
+            data = tail + block
+            for match in BZ2_STREAM_START.finditer(data):
+                position = offset - len(tail) + match.start()
+                if position > starts[-1]:
+                    starts.append(position)
+            # keep enough to find a marker cut in two by the block boundary
+            tail = data[-9:]
+            offset += len(block)
+
+    segments = []
+    segment_start = 0
+    for start in starts[1:]:
+        if start - segment_start >= BZ2_BLOCK:
+            segments.append((segment_start, start))
+            segment_start = start
+    segments.append((segment_start, offset))
+    return segments
+
+
+def decompress_bz2_segment(job):
+    """Pool worker: decompress a range of whole bzip2 streams, or return None if it is not one"""
+    osm_file, start, end = job
+    with open(osm_file, 'rb') as f:
+        f.seek(start)
+        segment = f.read(end - start)
+    parts = []
+    try:
+        while segment:
+            decompressor = bz2.BZ2Decompressor()
+            parts.append(decompressor.decompress(segment))
+            segment = decompressor.unused_data
+        # Only a finished stream refuses more input; a range cut at a false
+        # start marker ends part way through one
+        decompressor.decompress('')
+    except EOFError:
+        return ''.join(parts)
+    except IOError:
+        pass
+    return None
+
+
+def bz2_parallel_chunks(osm_file, processes):
+    """Yield the decompressed data of osm_file, its streams decompressed in a pool"""
+    segments = bz2_segments(osm_file)
+    if len(segments) == 1:
+        for data in bz2_chunks(osm_file):
+            yield data
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Ranges that did not decompress on their own are redone together
+        failed_start = None
+        for i in range(0, len(segments), processes * BZ2_WINDOW):
+            window = segments[i:i + processes * BZ2_WINDOW]
+            jobs = [(osm_file, start, end) for start, end in window]
+            for (start, end), data in zip(window, pool.imap(decompress_bz2_segment, jobs)):
+                if data is None:
+                    if failed_start is None:
+                        failed_start = start
+                    continue
+                if failed_start is not None:
+                    for chunk in bz2_chunks(osm_file, failed_start, start):
+                        yield chunk
+                    failed_start = None
+                yield data
+        if failed_start is not None:
+            for chunk in bz2_chunks(osm_file, failed_start):
+                yield chunk
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# ================================================== #
+#               Build Manifest                       #
+# ================================================== #
+"""
+Every stage below (sample, audit, CSV export, DB load) is expensive on the
+full extract, and rerunning one on stale inputs is how a database ends up
+holding old shape_element() output. The build manifest records, per
+stage, a hash over everything the stage reads: input files, the reference
+tables and the code that does the work. A stage is rerun only when that
+hash changed or one of its outputs is missing, and always when it did.
+
+File hashes are kept with each file's size and mtime, so unchanged files
+are not read again just to find out they are unchanged.
+"""
+BUILD_MANIFEST = "build_manifest.json"
+HASH_BLOCK = 1024 * 1024
+
+def value_digest(value):
+    """Hash of a reference table or setting (sets and dicts hash the same in any order)"""
+    if isinstance(value, (set, frozenset)):
+        value = sorted(value)
+    elif isinstance(value, dict):
+        value = sorted(value.items())
+    return hashlib.sha1(repr(value)).hexdigest()
+
+
+def code_digest(functions):
+    """Hash of the bytecode and constants of functions, classes' methods included
+
+    Line numbers and file names are left out, so edits elsewhere in the
+    notebook do not count as a change to these functions.
+    """
+    sha = hashlib.sha1()
+
+    def add_code(code):
+        sha.update(code.co_code)
+        sha.update(repr(code.co_names))
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                add_code(const)
+            else:
+                sha.update(repr(const))
+
+    for function in functions:
+        if isinstance(function, (type, types.ClassType)):
+            for name, member in sorted(vars(function).items()):
+                if isinstance(member, types.FunctionType):
+                    add_code(member.__code__)
+        else:
+            add_code(function.__code__)
+    return sha.hexdigest()
+
+
+class BuildManifest(object):
+    """Input hashes of the last successful run of each stage, kept in a JSON file"""
+
+    def __init__(self, path=BUILD_MANIFEST):
+        self.path = path
+        self.files = {}
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.files = saved.get('files', {})
+            self.stages = saved.get('stages', {})
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump({'files': self.files, 'stages': self.stages}, f, indent=1, sort_keys=True)
+
+    def file_digest(self, path):
+        """sha1 of a file, re-read only if its size or mtime changed"""
+        stat = os.stat(path)
+        known = self.files.get(path)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+            return known['sha1']
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), ''):
+                sha.update(block)
+        self.files[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha.hexdigest()}
+        return self.files[path]['sha1']
+
+    def stage_key(self, inputs):
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def stale(self, stage, inputs, outputs):
+        """True if stage has to run: its inputs changed or an output is missing
+
+        A stale stage loses its record until record() is called, so a run
+        that fails half way is redone next time.
+        """
+        current = (self.stages.get(stage) == self.stage_key(inputs)
+                   and all(os.path.exists(path) for path in outputs))
+        if not current and stage in self.stages:
+            del self.stages[stage]
+            self.save()
+        return not current
+
+    def record(self, stage, inputs):
+        """Mark stage as built from inputs"""
+        self.stages[stage] = self.stage_key(inputs)
+        self.save()
+
+build_manifest = BuildManifest()
+
+
+# ================================================== #
+#               Id Sets                              #
+# ================================================== #
+"""
+The sampler and the area filter both have to remember which nodes, ways
+and relations they keep while they stream through a file far bigger than
+memory. A Python set costs some 30 bytes per id; an IdBitmap costs one bit
+per id in the blocks that are actually used, so the node ids of a whole
+state fit in a few megabytes.
+"""
+ID_BLOCK_BITS = 16
+
+class IdBitmap(object):
+    """Set of integer ids stored as one bit per id in blocks of 2**ID_BLOCK_BITS ids
+
+    Only blocks holding at least one id are allocated, so ids spread over
+    the whole OSM id range cost a few bytes each instead of a set entry.
+    """
+
+    def __init__(self, ids=()):
+        self.blocks = {}
+        self.count = 0
+        for element_id in ids:
+            self.add(element_id)
+
+    def add(self, element_id):
+        element_id = int(element_id)
+        block = self.blocks.get(element_id >> ID_BLOCK_BITS)
+        if block is None:
+            block = self.blocks[element_id >> ID_BLOCK_BITS] = bytearray(1 << (ID_BLOCK_BITS - 3))
+        bit = element_id & ((1 << ID_BLOCK_BITS) - 1)
+        mask = 1 << (bit & 7)
+        if not block[bit >> 3] & mask:
+            block[bit >> 3] |= mask
+            self.count += 1
+
+    def __contains__(self, element_id):
+        element_id = int(element_id)
+        block = self.blocks.get(element_id >> ID_BLOCK_BITS)
+        if block is None:
+            return False
+        bit = element_id & ((1 << ID_BLOCK_BITS) - 1)
+        return bool(block[bit >> 3] & (1 << (bit & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        return len(self.blocks) << (ID_BLOCK_BITS - 3)
+
+
+# ================================================== #
+#               Buffered Output                      #
+# ================================================== #
+"""
+The sampler writes one ET.tostring() per element and the CSV export one
+csv row per shaped tuple, each a small write() through the file's own
+8 KB buffer. A BufferedOutput collects those pieces in a list and hands
+them to the file as one OUTPUT_BUFFER sized chunk, so the file sees a few
+large writes instead of millions of small ones.
+
+Given a BackgroundWriter, the chunks are written by its thread instead, so
+the next chunk is parsed and shaped while the last one goes to disk. The
+file write releases the GIL, which is what makes the overlap real. The
+queue holds at most WRITE_QUEUE chunks, so a slow disk holds the parser
+back rather than letting memory grow. One BackgroundWriter serves any
+number of files; chunks of a file are written in the order they were made.
+Whoever made the BackgroundWriter closes it once its outputs are closed,
+which waits for the last chunk and raises the first write error.
+Measured on a single core with the files in page cache, the thread gains
+nothing over writing inline, so it is off unless BACKGROUND_WRITES is set.
+"""
+OUTPUT_BUFFER = 1024 * 1024
+WRITE_QUEUE = 8
+BACKGROUND_WRITES = False
+
+class BackgroundWriter(object):
+    """Thread writing (file, chunk) pairs from a bounded queue"""
+
+    def __init__(self, max_chunks=WRITE_QUEUE):
+        self.queue = Queue.Queue(max_chunks)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            f, chunk = self.queue.get()
+            if f is None:
+                return
+            try:
+                if chunk is None:
+                    f.close()
+                elif self.error is None:
+                    f.write(chunk)
+            except Exception as e:
+                # Keep draining the queue so put() never blocks on a dead writer
+                if self.error is None:
+                    self.error = e
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, f, chunk, check=True):
+        """Queue chunk to be written to f; with check, raise an earlier write error first"""
+        if check:
+            self.check()
+        self.queue.put((f, chunk))
+
+    def close_file(self, f):
+        """Queue f to be closed once its queued chunks are written"""
+        self.queue.put((f, None))
+
+    def close(self, check=True):
+        """Write what is queued and stop the thread; with check, raise the first write error
+
+        check=False is for closing while another exception is on its way
+        out, which a write error must not replace.
+        """
+        if self.thread.is_alive():
+            self.queue.put((None, None))
+            self.thread.join()
+        if check:
+            self.check()
+
+
+class BufferedOutput(object):
+    """File-like wrapper gathering write()s into buffer_size chunks
+
+    The chunks go to f directly or, with a BackgroundWriter, through its
+    thread. close() writes the rest and closes f.
+    """
+
+    def __init__(self, f, buffer_size=OUTPUT_BUFFER, writer=None):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.writer = writer
+        self.pieces = []
+        self.size = 0
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def chunk(self):
+        chunk = ''.join(self.pieces)
+        self.pieces = []
+        self.size = 0
+        return chunk
+
+    def flush(self):
+        if self.pieces:
+            if self.writer is not None:
+                self.writer.put(self.f, self.chunk())
+            else:
+                self.f.write(self.chunk())
+
+    def close(self):
+        """Flush and close f; with a writer, its thread closes f after the last chunk
+
+        Write errors of a writer are then left for its close() to raise, so
+        closing the outputs never hides the error that ended the run.
+        """
+        if self.writer is not None:
+            if self.pieces:
+                self.writer.put(self.f, self.chunk(), check=False)
+            self.writer.close_file(self.f)
+        else:
+            self.flush()
+            self.f.close()
+
+
+# ================================================== #
+#               Single-Pass Audit Engine             #
+# ================================================== #
+"""
+Each audit below used to re-read the whole .osm file on its own,
+so a full audit cost one XML scan per question asked.
+audit_osm() parses the file once and hands every element to a list of auditors.
+An auditor is any object with a process(elem) method and
+a result attribute holding whatever it has collected.
+
+Auditors only see elements on their 'end' event, once all of their child
+<tag>s and <nd>s have been parsed. As in get_element(), the root is cleared
+after every top level element so memory stays flat however big the file is.
+"""
+def audit_osm(osmfile, auditors, top_level=('node', 'way', 'relation'), processes=1):
+    """Feed every auditor from a single iterparse pass and return their results
+
+    osmfile may be compressed; processes > 1 decompresses a multi-stream
+    .bz2 in that many processes.
+    """
+    context = iter(ET.iterparse(osm_input(osmfile, processes), events=('start', 'end')))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end':
+            for auditor in auditors:
+                auditor.process(elem)
+            if elem.tag in top_level:
+                root.clear()
+    return [auditor.result for auditor in auditors]
+
+class TagCounter(object):
+    """Count how many times each XML tag appears in the file"""
+
+    def __init__(self):
+        self.result = {}
+
+    def process(self, elem):
+        if elem.tag not in self.result:
+            self.result[elem.tag] = 1
         else:
-            tags[elem.tag] += 1
+            self.result[elem.tag] += 1
+
+def count_tags(osm_file):
+    tags, = audit_osm(osm_file, [TagCounter()])
     return tags
 
 
 # In[4]:
 
 # Did I manage to read the data? If so, how do the data look like?
-tags = count_tags(osm_file)
-pprint.pprint(tags)
+# The tag counts come from the single audit pass under "Running the Audits"
+# below, which reads the file once for them and for the street and zipcode audits.
 
 
 # Finally, I am able to figure out the way to read the .osm data. Believe it or not, I got stuck on figuring this out. The example in the Udacity lecture did not allude to reading data from my own computer drive. 
@@ -76,7 +619,10 @@ pprint.pprint(tags)
 #!/usr/bin/env python
 
 
-k = 50 # Parameter: take every k-th top level element
+k = 50 # Parameter: take every k-th way
+sample_seed = None # Parameter: draw ways at random (1 in k) from this seed instead
+sample_bytes = None # Parameter: reservoir-sample ways up to about this many output bytes
+NODE_SIZE_STEP = 64 # measure the size of every 64th node to estimate node bytes
 
 def get_element(osm_file, tags=('node', 'way', 'relation')):
     """Yield element if it is the right type of tag
@@ -84,24 +630,115 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
+    context = iter(ET.iterparse(osm_input(osm_file), events=('start', 'end')))
     _, root = next(context)
     for event, elem in context:
         if event == 'end' and elem.tag in tags:
             yield elem
             root.clear()
 
-with open(sample_file, 'wb') as output:
-    # The text coding needs to be converted to UTF-8 version
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
-
-    # Write every kth top level element
-    for i, element in enumerate(get_element(osm_file)):
-        if i % k == 0:
+# Taking every k-th top level element leaves ways without their nodes and
+# nodes no way uses, so the sample behaves nothing like the full file.
+# The sampler picks ways instead: every k-th way, 1 in k at random from a
+# seed, or a reservoir of ways holding about sample_bytes of output. The
+# first pass records the picked ways and the nodes they use in IdBitmaps;
+# the second writes exactly those nodes and ways, plus every relation whose
+# members all made it into the sample, so the sample is complete.
+# Memory holds the bitmaps and, in reservoir mode, the node refs of the
+# ways in the reservoir, never the elements of the file.
+
+def way_refs(element):
+    return [int(nd.attrib['ref']) for nd in element.iter('nd')]
+
+def reservoir_ways(osm_file, sample_bytes, seed=None):
+    """Uniform sample of ways whose estimated output is about sample_bytes
+
+    Every way gets a random priority and the ways with the lowest
+    priorities are kept while their estimated size fits. A way's size is
+    its own XML plus the average node size for each of its refs, so nodes
+    shared between ways are counted twice and the sample comes out a
+    little under sample_bytes.
+    """
+    rng = random.Random(seed)
+    reservoir = []  # max-heap on priority: (-priority, way id, refs, size)
+    total = 0
+    threshold = 1.0  # lowest priority dropped so far; ways above it can never fit
+    node_bytes, node_count = 0, 0
+    for i, element in enumerate(get_element(osm_file, ('node', 'way'))):
+        if element.tag == 'node':
+            if i % NODE_SIZE_STEP == 0:
+                node_bytes += len(ET.tostring(element, encoding='utf-8'))
+                node_count += 1
+            continue
+        priority = rng.random()
+        if priority >= threshold:
+            continue
+        refs = way_refs(element)
+        size = len(ET.tostring(element, encoding='utf-8'))
+        size += len(refs) * node_bytes // max(node_count, 1)
+        heapq.heappush(reservoir, (-priority, int(element.attrib['id']), refs, size))
+        total += size
+        while total > sample_bytes and len(reservoir) > 1:
+            priority, _, _, size = heapq.heappop(reservoir)
+            threshold = -priority
+            total -= size
+    return [(way_id, refs) for _, way_id, refs, _ in reservoir]
+
+def sample_ways(osm_file, k, seed=None, sample_bytes=None):
+    """First pass: return IdBitmaps of the picked ways and of the nodes they use"""
+    ways, nodes = IdBitmap(), IdBitmap()
+    if sample_bytes:
+        picked = reservoir_ways(osm_file, sample_bytes, seed)
+    else:
+        rng = random.Random(seed)
+        picked = ((int(element.attrib['id']), way_refs(element))
+                  for i, element in enumerate(get_element(osm_file, ('way',)))
+                  if (rng.random() * k < 1 if seed is not None else i % k == 0))
+    for way_id, refs in picked:
+        ways.add(way_id)
+        for ref in refs:
+            nodes.add(ref)
+    return ways, nodes
+
+def write_sample(osm_file, sample_file, k, seed=None, sample_bytes=None,
+                 background=BACKGROUND_WRITES):
+    """Write the sampled ways of osm_file, the nodes they use and the relations they complete"""
+    ways, nodes = sample_ways(osm_file, k, seed, sample_bytes)
+    kept = {'node': nodes, 'way': ways, 'relation': IdBitmap()}
+    writer = BackgroundWriter() if background else None
+    output = BufferedOutput(open(sample_file, 'wb'), writer=writer)
+    written = False
+    try:
+        # The text coding needs to be converted to UTF-8 version
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+
+        for element in get_element(osm_file):
+            if element.tag == 'relation':
+                members = element.findall('member')
+                if not members or not all(member.attrib['ref'] in kept[member.attrib['type']]
+                                          for member in members):
+                    continue
+            elif element.attrib['id'] not in kept[element.tag]:
+                continue
             output.write(ET.tostring(element, encoding='utf-8'))
+            if element.tag == 'relation':
+                kept['relation'].add(element.attrib['id'])
 
-    output.write('</osm>')
+        output.write('</osm>')
+        written = True
+    finally:
+        output.close()
+        if writer is not None:
+            writer.close(check=written)
+
+sample_inputs = {'osm': build_manifest.file_digest(osm_file), 'k': k, 'seed': sample_seed,
+                 'bytes': sample_bytes,
+                 'code': code_digest([write_sample, sample_ways, reservoir_ways, way_refs,
+                                      get_element, IdBitmap, BufferedOutput, BackgroundWriter])}
+if build_manifest.stale('sample', sample_inputs, [sample_file]):
+    write_sample(osm_file, sample_file, k, sample_seed, sample_bytes)
+    build_manifest.record('sample', sample_inputs)
 
 
 
@@ -131,7 +768,7 @@ def file_size(file_path):
     
 print "The full OpenStreetMap file is", file_size(osm_file)
 print "while its sample file size is", file_size(sample_file), ","
-print "for records systematically selected every", k, "th (top) row."
+print "for ways systematically selected every", k, "th way, with the nodes they use."
 
 
 # ## Data Cleaning
@@ -171,23 +808,33 @@ lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
 problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 
+### Reference data
+# The expected suffixes, the name mapping and the expected zipcodes live in
+# plain files under reference/<area>/ so another metro area can be plugged in
+# by pointing REFERENCE_DIR somewhere else. The lists are loaded into frozensets,
+# so the membership tests in the audit loops take constant time.
+REFERENCE_DIR = os.path.join("reference", "irving_tx")
+
+def native_text(text):
+    """Keep ASCII text as str, like the values ElementTree hands back"""
+    try:
+        return str(text)
+    except UnicodeEncodeError:
+        return text
+
+def read_reference_list(name, area_dir=REFERENCE_DIR):
+    """Return the non-blank, non-comment lines of a reference file as a frozenset"""
+    with codecs.open(os.path.join(area_dir, name), encoding='utf-8') as f:
+        return frozenset(native_text(line.strip()) for line in f
+                         if line.strip() and not line.startswith('#'))
+
+def read_reference_mapping(name, area_dir=REFERENCE_DIR):
+    """Return the problematic name -> corrected name mapping of a reference file"""
+    with open(os.path.join(area_dir, name)) as f:
+        return dict((native_text(k), native_text(v)) for k, v in json.load(f).iteritems())
+
 ### Street suffix - Wikipedia; https://en.wikipedia.org/wiki/Street_suffix
-expected = ["Alley","Annex","Arcade","Avenue","Bayou","Beach","Bend","Bluff","Bottom","Boulevard",
-            "Branch","Bridge","Brook","Burg","Bypass","Camp","Canyon","Cape","Causeway","Center",
-            "Circle","Cliff","Club","Common","Corner","Course","Court","Cove","Creek","Crescent",
-            "Crest","Crossing","Crossroad","Curve","Dale","Dam","Divide","Drive","Estate",
-            "Expressway","Extension","Fall","Ferry","Field","Flat","Ford","Forest","Forge","Fork",
-            "Fort","Freeway","Garden","Gateway","Glen","Green","Grove","Harbor","Haven","Heights",
-            "Highway","Hill","Hollow","Inlet","Island","Isle","Junction","Key","Knoll","Lake","Land",
-            "Landing","Lane","Light","Loaf","Lock","Lodge","Loop","Mall","Manor","Meadow","Mews","Mill",
-            "Mission","Motorway","Mount","Mountain","Neck","Orchard","Oval","Overpass","Park","Parkway",
-            "Pass","Passage","Path","Pike","Pine","Place","Plain","Plaza","Point","Port","Prairie",
-            "Radial","Ramp","Ranch","Rapid","Rest","Ridge","River","Road","Route","Row","Rue","Run",
-            "Shoal","Shore","Skyway","Spring","Spur","Square","Station","Stravenue","Stream","Street",
-            "Summit","Terrace","Throughway","Trace","Track","Trafficway","Trail","Trailer","Tunnel",
-            "Turnpike","Underpass","Union","Valley","Viaduct","View","Village","Ville","Vista","Walk",
-            "Wall","Way","Well","Wells",
-            "Tollway"]
+expected = read_reference_list("street_suffixes.txt")
 
 """
 Names to be corrected andtheir corrected names
@@ -196,36 +843,7 @@ This mapping from problematic to corrected names is used
 to convert problematic or unstandardized names/phrases/addresses
 to corrected ones.
 """
-mapping = { # "St": "Street",
-            "Ave": "Avenue", "Ave.": "Avenue",
-            "Blvd.": "Boulevard", "Blvd": "Boulevard",
-            "Las Colinas Blvd E":"E Las Colinas Boulevard",
-            "Dr.": "Drive", " Dr": " Drive", 
-            "W Pioneer Dr": "W Pioneer Drive",
-            "Golden Gate Dr.":"Golden Gate Drive","1421 Golden Gate Dr.":"1421 Golden Gate Drive",
-            "I-635": "I-635 Interstate Highway",
-            "Ln":"Lane", "Pkwy":"Parkway",
-            "Rd.": "Road"," Rd": " Road",
-            "St.": "Street",
-            "Francis St": "Francis Street",
-            "North Loop 12":"US 12 Highway",
-            "North Highway 121":"US 121 Highway", 
-            "State Hwy 121":"US 121 Highway",
-            "Business 121":"US 121 Highway",
-            "E Sandy Lake Rd #140":"#140 E Sandy Lake Road",
-            "N Interstate 35E #207":"#207 I-35 Highway" ,
-            "S Interstate 35E":"I-35 Highway",
-            "Luna Road #700":"#700 Luna Road",
-            "East Technology Boulevard;Technology Boulevard East":"E Technology Boulevard",
-            "Technology Boulevard East":"E Technology Boulevard",
-            "Valley Ranch Parkway East":"E Valley Ranch Parkway",
-            "Valley Ranch Parkway South":"S Valley Ranch Parkway",
-            "Backbay Drive West":"W Backbay Drive",
-            "East Technology Boulevard;Technology Boulevard West":"Technology Boulevard",
-            "East Technology Boulevard;E Technology Boulevard":"Technology Boulevard",
-            "Lago Vista West":"W Lago Vista",
-            "Story Road West":"W Story Road"
-            }
+mapping = read_reference_mapping("street_mapping.json")
 
 # Collecting unexpected street names 
 # based on unexpected or unstandardized street name suffix
@@ -241,43 +859,201 @@ def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 # Gathering problematic streetnames by their suffix values for updating
-def audit(osmfile):
-    osm_file = open(osmfile, "r")
-    street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+class StreetTypeAuditor(object):
+    """Group unexpected street names by their suffix"""
+
+    def __init__(self):
+        self.result = defaultdict(set)
+
+    def process(self, elem):
         if elem.tag == "node" or elem.tag == "way":
             for tag in elem.iter("tag"):
                 if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
+                    audit_street_type(self.result, tag.attrib['v'])
+
+def audit(osmfile):
+    street_types, = audit_osm(osmfile, [StreetTypeAuditor()])
     return street_types
 
+# Compiling the mapping into a single regular expression.
+# Keys are tried longest first and may not start or end inside a word,
+# so "Dr" no longer matches inside "Drive" (the "DrDrive" problem)
+# and each name is corrected in one left-to-right scan.
+# The start-of-word check sits after the first character so that every
+# alternative begins with a literal and the regex engine can skip
+# straight to positions holding one of those first characters.
+# The scan takes the leftmost match, so a key whose end overlaps the start
+# of a longer key must give way to it: " Rd" is not taken where "Rd." follows.
+def compile_mapping(mapping):
+    keys = sorted(mapping, key=len, reverse=True)
+    alternatives = []
+    for k in keys:
+        pattern = re.escape(k[0])
+        if re.match(r'\w', k):
+            pattern += r'(?<!\w' + re.escape(k[0]) + ')'
+        pattern += re.escape(k[1:])
+        if re.search(r'\w$', k):
+            pattern += r'(?!\w)'
+        for rest in sorted(set(longer[len(k) - i:] for longer in keys for i in range(1, len(k))
+                               if longer != k and len(longer) > len(k) - i
+                               and longer.startswith(k[i:]))):
+            pattern += '(?!' + re.escape(rest) + ')'
+        alternatives.append(pattern)
+    return re.compile('|'.join(alternatives))
+
+# Compiled normalizers, built once per mapping (the mapping is kept alive with its normalizer)
+compiled_mappings = {}
+
+def street_normalizer(mapping):
+    """Return a function correcting a street name with mapping in a single scan"""
+    if id(mapping) not in compiled_mappings:
+        sub = compile_mapping(mapping).sub
+        lookup = lambda m: mapping[m.group()]
+        compiled_mappings[id(mapping)] = (mapping, lambda name: sub(lookup, name))
+    return compiled_mappings[id(mapping)][1]
+
 # Replacing the problematic street names with the legit street suffix 
 def update_name(name, mapping):
-    for k in mapping:
-        if k in name:
-            #name = name.replace(cleaned_name, mapping[k])
-            name = str.replace(name, k, mapping[k])
-    return name
+    return street_normalizer(mapping)(name)
 
 
-# In[9]:
+# Memoizing normalizations.
+# A few thousand distinct street names repeat across hundreds of thousands of tags,
+# so each raw value is normalized once and looked up afterwards.
+class NormalizationCache(object):
+    """Bounded memo of raw value -> normalized value in front of function
 
-# Printing out problematic streetname
-# These problematic street names are grouped by street name suffix
-street_types = audit(osm_file)
-pprint.pprint(dict(street_types))
+    Entries live in two generations: a hit in the older generation moves the
+    entry to the recent one, and when the recent generation fills up the older
+    one is dropped. This keeps the recently used values (an approximate LRU)
+    with plain dict lookups. hits and misses count lookups since creation.
 
+    The entries can be saved to and loaded from a small SQLite table, tagged with
+    a version string (e.g. a hash of the mapping) so stale normalizations are
+    never reused after the cleaning rules change.
+    """
 
-# In[10]:
+    def __init__(self, function, name, version, maxsize=100000):
+        self.function = function
+        self.name = name
+        self.version = version
+        self.maxsize = maxsize
+        self.recent = {}
+        self.older = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, value):
+        try:
+            result = self.recent[value]
+        except KeyError:
+            try:
+                result = self.older.pop(value)
+            except KeyError:
+                self.misses += 1
+                result = self.function(value)
+            else:
+                self.hits += 1
+            if len(self.recent) >= self.maxsize // 2:
+                self.older, self.recent = self.recent, {}
+            self.recent[value] = result
+        else:
+            self.hits += 1
+        return result
+
+    def entries(self):
+        """All cached raw value -> normalized value pairs"""
+        entries = dict(self.older)
+        entries.update(self.recent)
+        return entries
+
+    def merge(self, entries, hits, misses):
+        """Add the entries and lookup counts of another copy of this cache, e.g. a worker process's"""
+        for value, result in entries.iteritems():
+            if value not in self.recent:
+                if len(self.recent) >= self.maxsize // 2:
+                    self.older, self.recent = self.recent, {}
+                self.recent[value] = result
+        self.hits += hits
+        self.misses += misses
+
+    def load(self, db_path):
+        """Reuse the entries saved by an earlier run with the same version"""
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.execute(NORMALIZATION_CACHE_TABLE)
+            rows = conn.execute("SELECT raw, value FROM normalization_cache \
+                WHERE name=? AND version=? LIMIT ?;", (self.name, self.version, self.maxsize // 2))
+            self.older.update((raw, json.loads(value)) for raw, value in rows)
+        finally:
+            conn.close()
+
+    def save(self, db_path):
+        """Replace the saved entries for this cache with the current ones"""
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.execute(NORMALIZATION_CACHE_TABLE)
+            conn.execute("DELETE FROM normalization_cache WHERE name=?;", (self.name,))
+            entries = self.entries()
+            conn.executemany("INSERT INTO normalization_cache (name, version, raw, value) \
+                VALUES (?, ?, ?, ?);",
+                ((self.name, self.version, raw, json.dumps(value)) for raw, value in entries.iteritems()))
+            conn.commit()
+        finally:
+            conn.close()
+
+NORMALIZATION_CACHE_TABLE = "CREATE TABLE IF NOT EXISTS normalization_cache \
+    (name TEXT, version TEXT, raw TEXT, value TEXT, PRIMARY KEY (name, raw))"
+
+def mapping_version(mapping):
+    """Hash of the mapping contents and of the code applying it,
+    so saved normalizations follow edits to either"""
+    return hashlib.sha1(repr(sorted(mapping.items()))
+                        + code_digest([compile_mapping, street_normalizer])).hexdigest()
+
+clean_street_name = NormalizationCache(street_normalizer(mapping), "street", mapping_version(mapping))
+
+
+# In[ ]:
+
+# Abbreviations inside longer words are left alone now:
+# no more "DrDrive"/"Driveive" or "Avenuenue" double replacements
+for name, better_name in [("W Pioneer Dr", "W Pioneer Drive"),
+                          ("Golden Gate Drive", "Golden Gate Drive"),
+                          ("1421 Golden Gate Dr.", "1421 Golden Gate Drive"),
+                          ("Main Avenue", "Main Avenue"),
+                          ("Avenue K", "Avenue K"),
+                          ("Las Colinas Blvd E", "E Las Colinas Boulevard"),
+                          ("E Sandy Lake Rd #140", "#140 E Sandy Lake Road"),
+                          ("Story Rd.", "Story Road"),
+                          ("Oak Dr.", "Oak Drive"),
+                          ("Luna Rd. #5", "Luna Road #5")]:
+    assert update_name(name, mapping) == better_name, name
+
+
+# In[ ]:
+
+# Timing a million synthetic addr:street values:
+# the original substring loop vs. the compiled pattern
+def update_name_loop(name, mapping):
+    for k in mapping:
+        if k in name:
+            name = str.replace(name, k, mapping[k])
+    return name
 
-# Checking problematic street names
-# and obtaining the suggested, corrected names
-for st_type, ways in street_types.iteritems(): 
-    for name in ways:
-        better_name = update_name(name,mapping)
-        print name, "~>", better_name
+random.seed(0)
+street_bases = ["Main", "Walnut Hill", "Golden Gate", "Story", "Valley Ranch", "Las Colinas", "Rochelle"]
+street_suffixes = ["Ave", "Blvd", "Dr", "Drive", "Ln", "Pkwy", "Rd", "Road", "St.", "Street", "Way"]
+synthetic_streets = [random.choice(street_bases) + " " + random.choice(street_suffixes)
+                     for i in xrange(1000000)]
 
+normalize = street_normalizer(mapping)
+for label, clean in [("substring loop", lambda name: update_name_loop(name, mapping)),
+                     ("compiled pattern", normalize)]:
+    start = time.time()
+    for name in synthetic_streets:
+        clean(name)
+    print label, round(time.time() - start, 2), "seconds"
 
 
 # ### Zipcode Checking
@@ -291,10 +1067,12 @@ for st_type, ways in street_types.iteritems():
 # Any invalid zipcode? No
 zipcode_re = re.compile(r'^\d{5}([\-]?\d{4})?$')
 
+valid_zipcode = NormalizationCache(lambda zip_value: zipcode_re.search(zip_value) is not None,
+                                   "zipcode", zipcode_re.pattern)
+
 # Gathering zipcodes in 'zipcode' file
 def audit_zipcode(zipcodes,zip_value):
-    m = zipcode_re.search(zip_value)
-    if not m: #
+    if not valid_zipcode(zip_value): #
         zipcodes.add(zip_value)
 
 # Searching for zipcode values in the XML file
@@ -303,22 +1081,21 @@ def is_zipcode(elem):
     return (elem.attrib['k'] == "addr:postcode" or elem.attrib['k'] == "postal_code") 
 
 # Collecting zip codes in a file, zip,list
-def audit_zip(osmfile):
-    osm_file = open(osmfile, "r")
-    zip_list = set()
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+class ZipFormatAuditor(object):
+    """Collect zipcodes that are not in the 5-digit (ZIP+4) format"""
+
+    def __init__(self):
+        self.result = set()
+
+    def process(self, elem):
         if elem.tag == "node" or elem.tag == "way":
             for tag in elem.iter("tag"): 
                 if is_zipcode(tag):
-                    audit_zipcode(zip_list,tag.attrib['v'])
-    osm_file.close()
-    return zip_list
+                    audit_zipcode(self.result,tag.attrib['v'])
 
-# Priting problematic zipcodes based on their format
-# e.g. 5-digit zipcode, all numerical values, and no dashes
-zip_check = audit_zip(osm_file)
-print "Problematic zipcode format-wise:"
-pprint.pprint(zip_check)
+def audit_zip(osmfile):
+    zip_list, = audit_osm(osmfile, [ZipFormatAuditor()])
+    return zip_list
 
 
 # After checking zipcodes for legit 5-number values, I investigated whether these values are what I expected to obtain considering the Irving area. I obtained the expected zipcodes for Irving from a simple web search. If the areas that I selected only contained Irving addresses they the should all have the expected sip values. I would especially be very concerned if the zipcode values are not in the neighbouring areas or not for state of Texas' areas. 
@@ -330,27 +1107,138 @@ pprint.pprint(zip_check)
 # Comparing collected zipcodes with the expected zipcodes in Irving.
 
 # Expected zipcodes for Irving, Texas
-zip_expected = ["75014","75015","75016","75017","75038","75039","75060","75061","75062",
-                "75063","75220","75229","75261","75326","75368","76155"]
+zip_expected = read_reference_list("zipcodes.txt")
 
 # Searching for zipcodes in the XML file and
 # collecting zipcodes not in the expected list 
-def audit_zipcodes(osmfile):
-    osm_file = open(osmfile, "r")
-    zip_codes = {}
-    # Test: zip_codes = [75229,75049]
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+class ZipWhitelistAuditor(object):
+    """Count postcodes that are not in the expected zipcode list"""
+
+    def __init__(self):
+        # Test: self.result = [75229,75049]
+        self.result = {}
+
+    def process(self, elem):
         if elem.tag == "node" or elem.tag == "way":
             for tag in elem.iter("tag"):
                 if tag.attrib['k'] == "addr:postcode" and tag.attrib['v'] not in zip_expected:
-                    if tag.attrib['v'] not in zip_codes:
-                        zip_codes[tag.attrib['v']] = 1
+                    if tag.attrib['v'] not in self.result:
+                        self.result[tag.attrib['v']] = 1
                     else:
-                        zip_codes[tag.attrib['v']] += 1
+                        self.result[tag.attrib['v']] += 1
+
+def audit_zipcodes(osmfile):
+    zip_codes, = audit_osm(osmfile, [ZipWhitelistAuditor()])
     return zip_codes
 
+
+# ### Running the Audits
+# 
+# Rather than reading the .osm file once per audit, the tag counter and the street name and zipcode auditors are run together in a single pass. Any other auditor with a process() method and a result attribute can be added to the list.
+
+# In[ ]:
+
+# The audit results are kept in AUDIT_RESULTS, and only recomputed when the
+# .osm file, the reference tables or the auditors changed
+AUDIT_RESULTS = "audit_results.pkl"
+audit_inputs = {'osm': build_manifest.file_digest(osm_file),
+                'expected': value_digest(expected), 'mapping': value_digest(mapping),
+                'zip_expected': value_digest(zip_expected), 'zipcode_re': zipcode_re.pattern,
+                'code': code_digest([audit_osm, TagCounter, StreetTypeAuditor, ZipFormatAuditor,
+                                     ZipWhitelistAuditor, audit_street_type, is_street_name,
+                                     audit_zipcode, NormalizationCache])}
+if build_manifest.stale('audit', audit_inputs, [AUDIT_RESULTS]):
+    results = audit_osm(osm_file, [TagCounter(), StreetTypeAuditor(), ZipFormatAuditor(),
+                                   ZipWhitelistAuditor()])
+    with open(AUDIT_RESULTS, 'wb') as f:
+        pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+    build_manifest.record('audit', audit_inputs)
+
+with open(AUDIT_RESULTS, 'rb') as f:
+    tags, street_types, zip_check, zipcodes = pickle.load(f)
+
+# How many of each XML tag the file holds
+pprint.pprint(tags)
+
+
+# In[ ]:
+
+# Peak memory of a full audit must not grow with the file: the audit runs on
+# the sample file and on synthetic files 10 and 30 times its size, each in a
+# fresh child process. A child's ru_maxrss starts at the memory it inherited,
+# so the growth over its starting value is the audit's own peak.
+# It writes about 40 MB of scaled copies, so it only runs when asked for.
+CHECK_AUDIT_MEMORY = False
+AUDIT_RSS_COPIES = [1, 10, 30]
+AUDIT_RSS_LIMIT = 32 * 1024 # kilobytes a full audit may add, whatever the file size
+AUDIT_RSS_SLACK = 4 * 1024 # kilobytes the largest file may add over the smallest
+
+def write_scaled_osm(file_in, file_out, copies):
+    """Write the elements of file_in copies times over into one .osm file"""
+    with open(file_in, 'rb') as f:
+        body = f.read()
+    body = body[body.index('<osm>') + len('<osm>'):body.rindex('</osm>')]
+    with open(file_out, 'wb') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n')
+        for i in range(copies):
+            output.write(body)
+        output.write('</osm>')
+
+def audit_rss_child(file_in, results):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    audit_osm(file_in, [TagCounter(), StreetTypeAuditor(), ZipFormatAuditor(), ZipWhitelistAuditor()])
+    results.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start)
+
+def audit_rss_growth(file_in):
+    """Kilobytes of peak RSS a full audit of file_in adds, measured in a child process"""
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=audit_rss_child, args=(file_in, results))
+    child.start()
+    growth = results.get()
+    child.join()
+    return growth
+
+if __name__ == '__main__' and CHECK_AUDIT_MEMORY and resource is not None:
+    growth = {}
+    for copies in AUDIT_RSS_COPIES:
+        write_scaled_osm(sample_file, "scaled_osm", copies)
+        try:
+            growth[copies] = audit_rss_growth("scaled_osm")
+            print "%3dx sample (%s): peak RSS +%d KB" % (copies, file_size("scaled_osm"), growth[copies])
+        finally:
+            os.remove("scaled_osm")
+        assert growth[copies] < AUDIT_RSS_LIMIT, copies
+    assert growth[max(AUDIT_RSS_COPIES)] - growth[min(AUDIT_RSS_COPIES)] < AUDIT_RSS_SLACK, growth
+
+
+# In[ ]:
+
+# Printing out problematic streetname
+# These problematic street names are grouped by street name suffix
+pprint.pprint(dict(street_types))
+
+
+# In[ ]:
+
+# Checking problematic street names
+# and obtaining the suggested, corrected names
+for st_type, ways in street_types.iteritems(): 
+    for name in ways:
+        better_name = update_name(name,mapping)
+        print name, "~>", better_name
+
+
+# In[ ]:
+
+# Priting problematic zipcodes based on their format
+# e.g. 5-digit zipcode, all numerical values, and no dashes
+print "Problematic zipcode format-wise:"
+pprint.pprint(zip_check)
+
+
+# In[ ]:
+
 # Printing unexpected zipcodes with their counts 
-zipcodes = audit_zipcodes(osm_file)
 print "Zipcodes outside Irving city:"
 for zipcode in zipcodes:
     print  zipcode, zipcodes[zipcode]
@@ -392,12 +1280,19 @@ import schema
 
 OSM_PATH = "C:\Users\FA279J\Documents\Python\irving.osm" 
 
+# Area to cut out of OSM_PATH: None for the whole file, a (min_lon, min_lat,
+# max_lon, max_lat) bbox, WKT or GeoJSON text, or a .wkt/.geojson file
+AREA = None
+
 # Names of CSV files to be created 
 NODES_PATH = "nodes.csv"
 NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relation_members.csv"
+RELATION_TAGS_PATH = "relation_tags.csv"
 
 # Regular Expressions & Schema
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
@@ -412,107 +1307,169 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'type', 'ref', 'role', 'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+
+# SQL tables matching the CSV files, for loading straight into SQLite
+DB_PATH = "irvingtx.db"
+SQL_TABLES = [
+    ('nodes', NODE_FIELDS, "CREATE TABLE nodes \
+        (id INTEGER PRIMARY KEY NOT NULL, lat REAL, lon REAL, user TEXT, \
+        uid INTEGER, version INTEGER, changeset INTEGER, timestamp TEXT)"),
+    ('nodes_tags', NODE_TAGS_FIELDS, "CREATE TABLE nodes_tags \
+        (id INTEGER, key TEXT, value TEXT, type TEXT, \
+        FOREIGN KEY (id) REFERENCES nodes (id))"),
+    ('ways', WAY_FIELDS, "CREATE TABLE ways \
+        (id INTEGER PRIMARY KEY, user TEXT, uid INTEGER, version INTEGER, \
+        changeset TEXT, timestamp TEXT)"),
+    ('ways_nodes', WAY_NODES_FIELDS, "CREATE TABLE ways_nodes \
+        (id INTEGER, node_id INTEGER, position INTEGER, \
+        FOREIGN KEY (id) REFERENCES ways (id), \
+        FOREIGN KEY (node_id) REFERENCES nodes (id))"),
+    ('ways_tags', WAY_TAGS_FIELDS, "CREATE TABLE ways_tags \
+        (id INTEGER, key TEXT, value TEXT, type TEXT, \
+        FOREIGN KEY (id) REFERENCES ways (id))"),
+    ('relations', RELATION_FIELDS, "CREATE TABLE relations \
+        (id INTEGER PRIMARY KEY, user TEXT, uid INTEGER, version INTEGER, \
+        changeset INTEGER, timestamp TEXT)"),
+    ('relation_members', RELATION_MEMBERS_FIELDS, "CREATE TABLE relation_members \
+        (id INTEGER, type TEXT, ref INTEGER, role TEXT, position INTEGER, \
+        FOREIGN KEY (id) REFERENCES relations (id))"),
+    ('relation_tags', RELATION_TAGS_FIELDS, "CREATE TABLE relation_tags \
+        (id INTEGER, key TEXT, value TEXT, type TEXT, \
+        FOREIGN KEY (id) REFERENCES relations (id))"),
+]
 
 # Shaping the elements for a upload via CSV to tables
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict
+    """Clean and shape node, way or relation XML element to Python dict
     
     The cleaned data are updated in the resulting dataset. 
     The main tasks involved here are:
         1. Readiing the XML data.
         2. Detect possible incorrect data and replaced them with the correct one. 
         3. The resulting CSV files comprised of the cleaned data in their ideal formats
+
+    The cleaning itself happens in shape_rows(); this turns its tuples into dicts.
     """
+    shaped = shape_rows(element, node_attr_fields, way_attr_fields, problem_chars, default_tag_type)
+    if shaped is None:
+        return None
 
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []  
+    row, tags, refs = shaped
+    if element.tag == 'node':
+        return {'node': row_dict(node_attr_fields, row),
+                'node_tags': [row_dict(NODE_TAGS_FIELDS, tag) for tag in tags]}
+    elif element.tag == 'way':
+        return {'way': row_dict(way_attr_fields, row),
+                'way_nodes': [row_dict(WAY_NODES_FIELDS, way_node) for way_node in refs],
+                'way_tags': [row_dict(WAY_TAGS_FIELDS, tag) for tag in tags]}
+    elif element.tag == 'relation':
+        return {'relation': row_dict(RELATION_FIELDS, row),
+                'relation_members': [row_dict(RELATION_MEMBERS_FIELDS, member) for member in refs],
+                'relation_tags': [row_dict(RELATION_TAGS_FIELDS, tag) for tag in tags]}
+
+
+def row_dict(fields, row):
+    """Dict of a tuple row, leaving out the attributes the element did not have"""
+    return dict((field, value) for field, value in zip(fields, row) if value is not None)
+
+
+def shape_tag(element_id, secondary, problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Return the (id, key, value, type) row of a <tag> child, or None if it is skipped"""
+    k = secondary.attrib['k']
+    if LOWER_COLON.match(k):
+        tag_type, key = k.split(':', 1)
+        # Updating unexpected street values
+        ### https://discussions.udacity.com/t/updating-postal-code/245757/8
+        if k == 'addr:street':
+            return (element_id, key, clean_street_name(secondary.attrib['v']), tag_type)
+        return (element_id, key, secondary.attrib['v'], tag_type)
+    elif problem_chars.match(k):
+        return None
+    else:
+        return (element_id, k, secondary.attrib['v'], default_tag_type)
+
+
+def shape_rows(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
+               problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Clean and shape a node, way or relation XML element into plain tuple rows
+
+    Returns (element row, tag rows, reference rows), each row a tuple in the
+    column order of the matching *_FIELDS list. The reference rows are the
+    ordered <nd>s of a way or <member>s of a relation (empty for a node).
+    Attributes the element lacks are None.
+    Tuples are far cheaper to build than dicts and go straight to csv.writer
+    or executemany(), which matters at tens of millions of rows.
+    """
+    attrib = element.attrib
+    element_id = attrib['id']
+    tags = []
+    refs = []
 
     if element.tag == 'node':
-        for attrib in element.attrib:
-            # if attrib in NODE_FIELDS:
-            if attrib in node_attr_fields:
-                node_attribs[attrib] = element.attrib[attrib]
-        
         for secondary in element:
-        
-            node_tag = {}
-            if LOWER_COLON.match(secondary.attrib['k']):
-                node_tag['type'] = secondary.attrib['k'].split(':',1)[0]
-                node_tag['key'] = secondary.attrib['k'].split(':',1)[1]
-                node_tag['id'] = element.attrib['id']
-                node_tag['value'] = secondary.attrib['v']
-                tags.append(node_tag)
-                
-                # Updating unexpected street values
-                ### https://discussions.udacity.com/t/updating-postal-code/245757/8
-                if secondary.attrib["k"] == 'addr:street':
-                    node_tag["value"] = update_name(secondary.attrib["v"], mapping)
-                else:
-                    node_tag["value"] = secondary.attrib["v"]
-                
-            elif PROBLEMCHARS.match(secondary.attrib['k']):
-                continue
-            else:
-                node_tag['type'] = 'regular'
-                node_tag['key'] = secondary.attrib['k']
-                node_tag['id'] = element.attrib['id']
-                node_tag['value'] = secondary.attrib['v']
-                tags.append(node_tag)
-                        
-        return {'node': node_attribs, 'node_tags': tags}
-        
+            tag = shape_tag(element_id, secondary, problem_chars, default_tag_type)
+            if tag is not None:
+                tags.append(tag)
+        return tuple(map(attrib.get, node_attr_fields)), tags, refs
+
     elif element.tag == 'way':
-        for attrib in element.attrib:
-            if attrib in WAY_FIELDS:
-                way_attribs[attrib] = element.attrib[attrib]
-        
-        count_tag = 0
         for secondary in element:
-            way_tag = {}
-            way_node = {}
-            
             if secondary.tag == 'tag':
-                if LOWER_COLON.match(secondary.attrib['k']):
-                    way_tag['type'] = secondary.attrib['k'].split(':',1)[0]
-                    way_tag['key'] = secondary.attrib['k'].split(':',1)[1]
-                    way_tag['id'] = element.attrib['id']
-                    way_tag['value'] = secondary.attrib['v']
-                    tags.append(way_tag)
-                    
-                    # Updating unexpected street values
-                    if secondary.attrib["k"] == 'addr:street':
-                        way_tag["value"] = update_name(secondary.attrib["v"], mapping)
-                    else:
-                        way_tag["value"] = secondary.attrib["v"]
-                        
-                elif PROBLEMCHARS.match(secondary.attrib['k']):
-                    continue
-                else:
-                    way_tag['type'] = 'regular'
-                    way_tag['key'] = secondary.attrib['k']
-                    way_tag['id'] = element.attrib['id']
-                    way_tag['value'] = secondary.attrib['v']
-                    tags.append(way_tag)
-                    
+                tag = shape_tag(element_id, secondary, problem_chars, default_tag_type)
+                if tag is not None:
+                    tags.append(tag)
             elif secondary.tag == 'nd':
-                way_node['id'] = element.attrib['id']
-                way_node['node_id'] = secondary.attrib['ref']
-                way_node['position'] = count_tag
-                count_tag += 1
-                way_nodes.append(way_node)
-        
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+                refs.append((element_id, secondary.attrib['ref'], len(refs)))
+        return tuple(map(attrib.get, way_attr_fields)), tags, refs
+
+    elif element.tag == 'relation':
+        for secondary in element:
+            if secondary.tag == 'tag':
+                tag = shape_tag(element_id, secondary, problem_chars, default_tag_type)
+                if tag is not None:
+                    tags.append(tag)
+            elif secondary.tag == 'member':
+                member = secondary.attrib
+                refs.append((element_id, member['type'], member['ref'], member.get('role', ''), len(refs)))
+        return tuple(map(attrib.get, RELATION_FIELDS)), tags, refs
 
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+def get_element(osm_file, tags=('node', 'way', 'relation'), parser='etree', processes=1,
+                area=None):
+    """Yield element if it is the right type of tag
+
+    parser names the XML backend in XML_PARSERS. 'etree' and 'lxml' yield
+    Elements; 'expat' yields OSMRecords, which offer the same tag, attrib
+    and iteration over children that shape_rows() relies on.
+
+    osm_file may be compressed (see osm_input()); processes > 1
+    decompresses a multi-stream .bz2 in that many processes.
 
+    With area set (see parse_area()) only the elements inside it are
+    yielded, with the nodes their ways need (see area_elements()). The file
+    is read twice, so osm_file has to be a path.
+    """
+    if parser not in XML_PARSERS:
+        raise ValueError("Unknown XML parser {0!r}, expected one of {1}".format(
+            parser, ", ".join(sorted(XML_PARSERS))))
+    if area is not None:
+        if not isinstance(osm_file, basestring):
+            raise ValueError("An area filter reads the file twice and needs a path, not a file object")
+        return area_elements(lambda: XML_PARSERS[parser](osm_input(osm_file, processes),
+                                                         ('node', 'way', 'relation')),
+                             area, tags)
+    return XML_PARSERS[parser](osm_input(osm_file, processes), tags)
+
+
+def etree_elements(osm_file, tags):
+    """cElementTree iterparse, clearing the root after each element"""
     context = ET.iterparse(osm_file, events=('start', 'end'))
     _, root = next(context)
     for event, elem in context:
@@ -521,6 +1478,543 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
             root.clear()
 
 
+def lxml_elements(osm_file, tags):
+    """lxml iterparse, which only reports the wanted tags to Python"""
+    if lxml_etree is None:
+        raise ImportError("the 'lxml' XML parser needs the lxml package")
+    for event, elem in lxml_etree.iterparse(osm_file, events=('end',), tag=tags):
+        yield elem
+        # drop the element and the already processed siblings before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class OSMRecord(tuple):
+    """(tag, attrib, children) offering just enough of an Element for shape_rows()"""
+    __slots__ = ()
+    tag = property(itemgetter(0))
+    attrib = property(itemgetter(1))
+
+    def __iter__(self):
+        return iter(self[2])
+
+# tuple.__new__ is a C call, unlike a Python __init__ run for every <tag> and <nd>
+new_record = partial(tuple.__new__, OSMRecord)
+
+
+EXPAT_BLOCK = 64 * 1024
+# The only elements OSM nests inside a node, way or relation
+OSM_CHILD_TAGS = frozenset(['tag', 'nd', 'member'])
+
+def expat_elements(osm_file, tags):
+    """expat callbacks building an OSMRecord per wanted element, no Element trees
+
+    Only a start handler is installed: a <tag>, <nd> or <member> is added to
+    the open record, and any other start tag closes it. That saves a Python
+    call per end tag, but means tags can only name top level elements.
+    """
+    wanted = frozenset(tags)
+    if wanted & OSM_CHILD_TAGS:
+        raise ValueError("The expat parser only yields top level elements, not {0}".format(
+            ", ".join(sorted(wanted & OSM_CHILD_TAGS))))
+    done = []
+    current = []
+
+    def start(name, attrib):
+        if name in OSM_CHILD_TAGS:
+            if current:
+                current[0][2].append(new_record((name, attrib, ())))
+        else:
+            if current:
+                done.append(current.pop())
+            if name in wanted:
+                current.append(new_record((name, attrib, [])))
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    f = osm_file if hasattr(osm_file, 'read') else open(osm_file, 'rb')
+    try:
+        while True:
+            data = f.read(EXPAT_BLOCK)
+            parser.Parse(data, not data)
+            if not data and current:
+                done.append(current.pop())
+            for record in done:
+                yield record
+            del done[:]
+            if not data:
+                break
+    finally:
+        if f is not osm_file:
+            f.close()
+
+
+XML_PARSERS = {'etree': etree_elements,
+               'lxml': lxml_elements,
+               'expat': expat_elements}
+
+
+# PBF input
+# An .osm.pbf file is a sequence of blobs, each a 4-byte length, a BlobHeader
+# and a (usually zlib compressed) Blob, all protocol buffer messages. The
+# first blob is the OSMHeader, the rest OSMData PrimitiveBlocks holding a
+# string table and groups of nodes, DenseNodes, ways or relations.
+# https://wiki.openstreetmap.org/wiki/PBF_Format
+PBF_FEATURES = frozenset(['OsmSchema-V0.6', 'DenseNodes'])
+PBF_MEMBER_TYPES = ['node', 'way', 'relation']
+# PrimitiveBlock fields saying how its coordinates and timestamps are scaled
+PBF_BLOCK_FIELDS = {17: 'granularity', 18: 'date_granularity',
+                    19: 'lat_offset', 20: 'lon_offset'}
+PBF_WINDOW = 4
+
+def pb_varint(buf, pos):
+    """Decode the varint of bytearray buf at pos, returning (value, next pos)"""
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def pb_fields(buf):
+    """Yield (field number, value) of a message: an int, or a bytearray if length delimited"""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key = buf[pos]
+        if key < 0x80:
+            pos += 1
+        else:
+            key, pos = pb_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = pb_varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = pb_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {0}".format(wire_type))
+        yield key >> 3, value
+
+
+def pb_packed(buf):
+    """Decode a packed repeated varint field"""
+    # pb_varint() inlined: this loop sees every id, coordinate and ref
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        byte = buf[pos]
+        pos += 1
+        if byte < 0x80:
+            append(byte)
+            continue
+        value = byte & 0x7f
+        shift = 7
+        while True:
+            byte = buf[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        append(value)
+    return values
+
+
+def pb_signed(value):
+    """int32/int64 stored as a plain varint (two's complement on 64 bits)"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def pb_zigzag(value):
+    """sint32/sint64 stored zigzag encoded"""
+    return (value >> 1) ^ -(value & 1)
+
+
+def pb_delta(values):
+    """Undo the zigzag and delta coding of a packed sint field"""
+    total = 0
+    decoded = []
+    for value in values:
+        total += (value >> 1) ^ -(value & 1)
+        decoded.append(total)
+    return decoded
+
+
+def pbf_blobs(pbf_file):
+    """Yield (blob type, raw Blob message) for each blob of the file"""
+    with open(pbf_file, 'rb') as f:
+        while True:
+            size = f.read(4)
+            if not size:
+                break
+            header = bytearray(f.read(struct.unpack('>I', size)[0]))
+            blob_type = None
+            data_size = 0
+            for field, value in pb_fields(header):
+                if field == 1:
+                    blob_type = str(value)
+                elif field == 3:
+                    data_size = value
+            yield blob_type, f.read(data_size)
+
+
+def pbf_blob_data(blob):
+    """Uncompressed contents of a Blob message"""
+    for field, value in pb_fields(bytearray(blob)):
+        if field == 1:
+            return value
+        elif field == 3:
+            return bytearray(zlib.decompress(str(value)))
+        elif field in (4, 5, 6, 7):
+            raise ValueError("Only raw and zlib compressed PBF blobs are supported")
+    return bytearray()
+
+
+def check_pbf_header(blob):
+    """Raise ValueError if the OSMHeader requires features this reader lacks"""
+    for field, value in pb_fields(pbf_blob_data(blob)):
+        if field == 4 and str(value) not in PBF_FEATURES:
+            raise ValueError("PBF file requires unsupported feature {0}".format(value))
+
+
+def pbf_timestamp(timestamp, date_granularity):
+    """XML timestamp string of a PBF timestamp in date_granularity milliseconds"""
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp * date_granularity // 1000))
+
+
+def pbf_coordinates(values, offset, granularity):
+    """XML lat or lon strings, with their 7 decimals, of PBF coordinates"""
+    return ['%.7f' % ((offset + granularity * value) * 1e-9) for value in values]
+
+
+def pbf_tag_records(keys, vals, strings):
+    """<tag> children of an element from its key and value string ids"""
+    return [('tag', {'k': strings[k], 'v': strings[v]}, ())
+            for k, v in zip(keys, vals)]
+
+
+def pbf_element(message, strings, date_granularity):
+    """(attrib, tag tuples, other fields) of a Node, Way or Relation message"""
+    attrib = {}
+    keys = vals = ()
+    fields = {}
+    for field, value in pb_fields(message):
+        if field == 1:
+            attrib['id'] = value
+        elif field == 2:
+            keys = pb_packed(value)
+        elif field == 3:
+            vals = pb_packed(value)
+        elif field == 4:
+            info = dict(pb_fields(value))
+            if 1 in info:
+                attrib['version'] = str(info[1])
+                attrib['timestamp'] = pbf_timestamp(pb_signed(info.get(2, 0)), date_granularity)
+                attrib['changeset'] = str(pb_signed(info.get(3, 0)))
+                attrib['uid'] = str(pb_signed(info.get(4, 0)))
+                attrib['user'] = strings[info.get(5, 0)]
+        else:
+            fields[field] = value
+    return attrib, pbf_tag_records(keys, vals, strings), fields
+
+
+def pbf_dense_nodes(dense, strings, block):
+    """(tag, attrib, children) tuples of a DenseNodes message, decoded a column at a time"""
+    fields = dict(pb_fields(dense))
+    ids = map(str, pb_delta(pb_packed(fields.get(1, ''))))
+    lats = pbf_coordinates(pb_delta(pb_packed(fields.get(8, ''))), block['lat_offset'],
+                           block['granularity'])
+    lons = pbf_coordinates(pb_delta(pb_packed(fields.get(9, ''))), block['lon_offset'],
+                           block['granularity'])
+    keys_vals = pb_packed(fields.get(10, ''))
+
+    info = dict(pb_fields(fields[5])) if 5 in fields else {}
+    if info:
+        date_granularity = block['date_granularity']
+        metadata = zip(map(str, pb_packed(info.get(1, ''))),
+                       [pbf_timestamp(timestamp, date_granularity)
+                        for timestamp in pb_delta(pb_packed(info.get(2, '')))],
+                       map(str, pb_delta(pb_packed(info.get(3, '')))),
+                       map(str, pb_delta(pb_packed(info.get(4, '')))),
+                       [strings[sid] for sid in pb_delta(pb_packed(info.get(5, '')))])
+    else:
+        metadata = [None] * len(ids)
+
+    records = []
+    kv = 0
+    for node_id, lat, lon, meta in zip(ids, lats, lons, metadata):
+        if meta is None:
+            attrib = {'id': node_id, 'lat': lat, 'lon': lon}
+        else:
+            version, timestamp, changeset, uid, user = meta
+            attrib = {'id': node_id, 'lat': lat, 'lon': lon, 'version': version,
+                      'timestamp': timestamp, 'changeset': changeset, 'uid': uid, 'user': user}
+        tags = []
+        # keys_vals holds each node's key/value string ids, ended by a 0
+        if keys_vals:
+            while keys_vals[kv] != 0:
+                tags.append(('tag', {'k': strings[keys_vals[kv]],
+                                     'v': strings[keys_vals[kv + 1]]}, ()))
+                kv += 2
+            kv += 1
+        records.append(('node', attrib, tags))
+    return records
+
+
+def decode_pbf_block(job):
+    """Pool worker: decompress and decode one OSMData blob
+
+    Returns a list of (tag, attrib, children) plain tuples, which pickle
+    several times faster than OSMRecords on their way back from the pool.
+    """
+    blob, tags = job
+    strings = []
+    groups = []
+    block = {'granularity': 100, 'date_granularity': 1000, 'lat_offset': 0, 'lon_offset': 0}
+    for field, value in pb_fields(pbf_blob_data(blob)):
+        if field == 1:
+            strings = [str(s).decode('utf-8') for field, s in pb_fields(value)]
+        elif field == 2:
+            groups.append(value)
+        elif field in PBF_BLOCK_FIELDS:
+            block[PBF_BLOCK_FIELDS[field]] = pb_signed(value)
+
+    date_granularity = block['date_granularity']
+    records = []
+    for group in groups:
+        for field, value in pb_fields(group):
+            if field == 2 and 'node' in tags:
+                records.extend(pbf_dense_nodes(value, strings, block))
+            elif field == 1 and 'node' in tags:
+                attrib, children, rest = pbf_element(value, strings, date_granularity)
+                attrib['id'] = str(pb_zigzag(attrib['id']))
+                attrib['lat'], = pbf_coordinates([pb_zigzag(rest.get(8, 0))],
+                                                 block['lat_offset'], block['granularity'])
+                attrib['lon'], = pbf_coordinates([pb_zigzag(rest.get(9, 0))],
+                                                 block['lon_offset'], block['granularity'])
+                records.append(('node', attrib, children))
+            elif field == 3 and 'way' in tags:
+                attrib, children, rest = pbf_element(value, strings, date_granularity)
+                attrib['id'] = str(attrib['id'])
+                for ref in pb_delta(pb_packed(rest.get(8, ''))):
+                    children.append(('nd', {'ref': str(ref)}, ()))
+                records.append(('way', attrib, children))
+            elif field == 4 and 'relation' in tags:
+                attrib, children, rest = pbf_element(value, strings, date_granularity)
+                attrib['id'] = str(attrib['id'])
+                roles = pb_packed(rest.get(8, ''))
+                refs = pb_delta(pb_packed(rest.get(9, '')))
+                types = pb_packed(rest.get(10, ''))
+                for role, ref, member_type in zip(roles, refs, types):
+                    children.append(('member', {'type': PBF_MEMBER_TYPES[member_type],
+                                                'ref': str(ref),
+                                                'role': strings[role]}, ()))
+                records.append(('relation', attrib, children))
+    return records
+
+
+def pbf_elements(pbf_file, tags=('node', 'way', 'relation'), processes=1):
+    """Yield OSMRecords of the wanted tags from an .osm.pbf file, in file order
+
+    With processes > 1 the blocks are decompressed and decoded in a process
+    pool, a few blocks per process at a time so memory stays bounded.
+    """
+    blobs = pbf_blobs(pbf_file)
+    blob_type, blob = next(blobs)
+    if blob_type != 'OSMHeader':
+        raise ValueError("{0} does not start with an OSMHeader blob".format(pbf_file))
+    check_pbf_header(blob)
+    jobs = ((blob, tags) for blob_type, blob in blobs if blob_type == 'OSMData')
+
+    if processes <= 1:
+        for job in jobs:
+            for tag, attrib, children in decode_pbf_block(job):
+                yield new_record((tag, attrib, map(new_record, children)))
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        while True:
+            window = list(itertools.islice(jobs, processes * PBF_WINDOW))
+            if not window:
+                break
+            for records in pool.imap(decode_pbf_block, window):
+                for tag, attrib, children in records:
+                    yield new_record((tag, attrib, map(new_record, children)))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Spatial filter
+# An area (a bounding box, or a polygon given as WKT or GeoJSON) cuts an
+# extract out of a larger file while it streams. The first pass keeps the
+# ids of the nodes inside the area, of the ways using any of them and of the
+# relations with a kept member, and collects every node those ways use. The
+# second pass yields the kept elements, including the nodes outside the area
+# that kept ways need, so every ways_nodes row has its node. Relation members
+# outside the extract keep their references, as in other OSM extract tools.
+# Ids are kept in IdBitmaps, one bit per id, so a city can be cut out of a
+# state-sized file without holding its elements in memory. Files are
+# expected in the usual order: nodes, then ways, then relations.
+AREA_BANDS = 256
+
+class Area(object):
+    """Polygon rings in lon/lat that points are tested against with the even-odd rule
+
+    Holes and the parts of a multipolygon are just more rings. The edges are
+    bucketed into AREA_BANDS latitude bands, so a point is only tested
+    against the edges that cross its band. A bounding box includes the
+    points on its edges.
+    """
+    rectangle = False
+
+    def __init__(self, rings):
+        rings = [[(float(lon), float(lat)) for lon, lat in ring] for ring in rings]
+        if not rings or min(len(ring) for ring in rings) < 3:
+            raise ValueError("An area needs rings of at least 3 points")
+        edges = []
+        for ring in rings:
+            edges.extend((lon1, lat1, lon2, lat2)
+                         for (lon1, lat1), (lon2, lat2) in zip(ring, ring[1:] + ring[:1])
+                         if lat1 != lat2)
+        lons = [lon for ring in rings for lon, lat in ring]
+        lats = [lat for ring in rings for lon, lat in ring]
+        self.bbox = (min(lons), min(lats), max(lons), max(lats))
+        self.band_height = (self.bbox[3] - self.bbox[1]) / AREA_BANDS or 1.0
+        self.bands = [[] for i in range(AREA_BANDS)]
+        for edge in edges:
+            low, high = sorted((edge[1], edge[3]))
+            for band in range(self.band(low), self.band(high) + 1):
+                self.bands[band].append(edge)
+
+    @classmethod
+    def from_bbox(cls, min_lon, min_lat, max_lon, max_lat):
+        area = cls([[(min_lon, min_lat), (max_lon, min_lat), (max_lon, max_lat), (min_lon, max_lat)]])
+        area.rectangle = True
+        return area
+
+    def band(self, lat):
+        return min(int((lat - self.bbox[1]) / self.band_height), AREA_BANDS - 1)
+
+    def contains(self, lon, lat):
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        if not (min_lon <= lon <= max_lon and min_lat <= lat <= max_lat):
+            return False
+        if self.rectangle:
+            return True
+        inside = False
+        for lon1, lat1, lon2, lat2 in self.bands[self.band(lat)]:
+            if (lat1 > lat) != (lat2 > lat) and lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+                inside = not inside
+        return inside
+
+
+def geojson_rings(geometry):
+    """All rings of a GeoJSON Polygon or MultiPolygon (or a Feature/FeatureCollection of them)"""
+    kind = geometry.get('type')
+    if kind == 'FeatureCollection':
+        return [ring for feature in geometry['features'] for ring in geojson_rings(feature)]
+    elif kind == 'Feature':
+        return geojson_rings(geometry['geometry'])
+    elif kind == 'Polygon':
+        return [[point[:2] for point in ring] for ring in geometry['coordinates']]
+    elif kind == 'MultiPolygon':
+        return [[point[:2] for point in ring] for polygon in geometry['coordinates'] for ring in polygon]
+    raise ValueError("Expected a GeoJSON Polygon or MultiPolygon, got {0!r}".format(kind))
+
+
+WKT_POLYGON = re.compile(r'^\s*(MULTI)?POLYGON\s*\(', re.IGNORECASE)
+WKT_RING = re.compile(r'\(([^()]+)\)')
+
+def wkt_rings(text):
+    """All rings of a WKT POLYGON or MULTIPOLYGON"""
+    if not WKT_POLYGON.match(text):
+        raise ValueError("Expected a WKT POLYGON or MULTIPOLYGON, got {0!r}".format(text[:40]))
+    return [[point.split()[:2] for point in ring.split(',')] for ring in WKT_RING.findall(text)]
+
+
+def parse_area(area):
+    """Area from a (min_lon, min_lat, max_lon, max_lat) bbox, WKT or GeoJSON text, a GeoJSON dict
+    or the path of a .wkt/.geojson file"""
+    if isinstance(area, Area):
+        return area
+    elif isinstance(area, dict):
+        return Area(geojson_rings(area))
+    elif isinstance(area, basestring):
+        if os.path.exists(area):
+            with open(area) as f:
+                area = f.read()
+        if area.lstrip().startswith('{'):
+            return Area(geojson_rings(json.loads(area)))
+        return Area(wkt_rings(area))
+    elif len(area) == 4:
+        return Area.from_bbox(*map(float, area))
+    raise ValueError("Cannot make an area of {0!r}".format(area))
+
+
+def area_elements(elements, area, tags=('node', 'way', 'relation')):
+    """Yield the elements of the wanted tags inside area, referentially complete
+
+    elements is a function returning a fresh iterator over all top level
+    elements of the file, as it is read twice (see the notes above).
+    """
+    area = parse_area(area)
+    inside = IdBitmap()
+    # kept ids by element type, the nodes being those inside plus those kept ways use
+    kept = {'node': IdBitmap(), 'way': IdBitmap(), 'relation': IdBitmap()}
+    nodes, ways, relations = kept['node'], kept['way'], kept['relation']
+
+    for element in elements():
+        if element.tag == 'node':
+            attrib = element.attrib
+            if 'lat' in attrib and area.contains(float(attrib['lon']), float(attrib['lat'])):
+                inside.add(attrib['id'])
+                nodes.add(attrib['id'])
+        elif element.tag == 'way':
+            refs = [child.attrib['ref'] for child in element if child.tag == 'nd']
+            if any(ref in inside for ref in refs):
+                ways.add(element.attrib['id'])
+                for ref in refs:
+                    nodes.add(ref)
+        elif element.tag == 'relation':
+            for child in element:
+                if child.tag == 'member':
+                    member = child.attrib
+                    if member['type'] in kept and member['ref'] in kept[member['type']]:
+                        relations.add(element.attrib['id'])
+                        break
+
+    for element in elements():
+        if element.tag in tags and element.attrib['id'] in kept[element.tag]:
+            yield element
+
+
+def write_area_extract(osm_file, extract_file, area):
+    """Write the elements of osm_file inside area (see area_elements()) to extract_file"""
+    with open(extract_file, 'wb') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+        for element in get_element(osm_file, area=area):
+            output.write(ET.tostring(element, encoding='utf-8'))
+        output.write('</osm>')
+
+
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
     if validator.validate(element, schema) is not True:
@@ -531,6 +2025,359 @@ def validate_element(element, validator, schema=SCHEMA):
         raise Exception(message_string.format(field, error_string))
 
 
+# Fast validation
+# Calling cerberus on every element is several times slower than shaping it,
+# so schema.schema is compiled once into per-table column checks instead.
+# Rows are checked a batch at a time: each column is type checked (and coerced
+# only if it needs to be) with C-level map()/set() calls, and only a batch that
+# fails is re-checked row by row to find out which rows and fields are wrong.
+SCHEMA_TYPES = {'string': frozenset([str, unicode]),
+                'integer': frozenset([int, long]),
+                'float': frozenset([float]),
+                'number': frozenset([int, long, float]),
+                'boolean': frozenset([bool])}
+SCHEMA_RULES = frozenset(['required', 'type', 'coerce', 'regex', 'allowed'])
+NoneType = type(None)
+# Ids and counts arrive from the XML as strings; a column of them can be
+# checked with one isdigit() over the joined column instead of int() per value
+DIGIT_COERCIONS = frozenset([int, long])
+
+class TableValidator(object):
+    """Checks for the tuple rows of one table, compiled from its cerberus-style schema"""
+
+    def __init__(self, table, fields, field_rules):
+        self.table = table
+        self.columns = []
+        for field, rules in sorted(field_rules.iteritems()):
+            unknown = set(rules) - SCHEMA_RULES
+            if unknown:
+                raise ValueError("Unsupported schema rules for {0}.{1}: {2}".format(
+                    table, field, ", ".join(sorted(unknown))))
+            if 'coerce' in rules and not callable(rules['coerce']):
+                raise ValueError("Only callable coerce rules are supported ({0}.{1})".format(table, field))
+            self.columns.append((
+                fields.index(field) if field in fields else None,
+                field,
+                rules.get('required', False),
+                rules.get('coerce'),
+                rules.get('type'),
+                re.compile(rules['regex'] + '$') if 'regex' in rules else None,
+                frozenset(rules['allowed']) if 'allowed' in rules else None))
+
+    def batch_is_valid(self, rows):
+        """Fast path: True if every row of the batch passes every check"""
+        columns = zip(*rows)
+        for index, field, required, coerce, type_name, pattern, allowed in self.columns:
+            if index is None:
+                if required:
+                    return False
+                continue
+            column = columns[index]
+            if coerce in DIGIT_COERCIONS and pattern is None and allowed is None:
+                try:
+                    if all(column) and ''.join(column).isdigit():
+                        continue
+                except TypeError:
+                    # not all strings; left to the checks below
+                    pass
+            column_types = set(map(type, column))
+            if NoneType in column_types:
+                if required:
+                    return False
+                column = [value for value in column if value is not None]
+                column_types.discard(NoneType)
+            if type_name is not None and not column_types <= SCHEMA_TYPES[type_name]:
+                # Only columns of the wrong type pay for the coercion
+                if coerce is None:
+                    return False
+                try:
+                    column = map(coerce, column)
+                except (TypeError, ValueError):
+                    return False
+                if (coerce not in SCHEMA_TYPES[type_name]
+                        and not set(map(type, column)) <= SCHEMA_TYPES[type_name]):
+                    return False
+            elif coerce is not None and (pattern is not None or allowed is not None):
+                try:
+                    column = map(coerce, column)
+                except (TypeError, ValueError):
+                    return False
+            if pattern is not None and not all(map(pattern.match, column)):
+                return False
+            if allowed is not None and not set(column) <= allowed:
+                return False
+        return True
+
+    def row_errors(self, row):
+        """Slow path: list of (field, message) for everything wrong with one row"""
+        errors = []
+        for index, field, required, coerce, type_name, pattern, allowed in self.columns:
+            value = row[index] if index is not None else None
+            if value is None:
+                if required:
+                    errors.append((field, "required field"))
+                continue
+            if coerce is not None:
+                try:
+                    value = coerce(value)
+                except (TypeError, ValueError):
+                    errors.append((field, "field '{0}' cannot be coerced".format(field)))
+                    continue
+            if type_name is not None and type(value) not in SCHEMA_TYPES[type_name]:
+                errors.append((field, "must be of {0} type".format(type_name)))
+            elif pattern is not None and not pattern.match(value):
+                errors.append((field, "value does not match regex '{0}'".format(pattern.pattern[:-1])))
+            elif allowed is not None and value not in allowed:
+                errors.append((field, "unallowed value {0}".format(value)))
+        return errors
+
+
+# Elements shaped between checks of the pending rows
+VALIDATION_BATCH = 10000
+
+# shape_element() keys of the tables in CSV_OUTPUTS/SQL_TABLES order
+SCHEMA_TABLES = ['node', 'node_tags', 'way', 'way_nodes', 'way_tags',
+                 'relation', 'relation_members', 'relation_tags']
+
+def compile_schema(schema=SCHEMA):
+    """Return a TableValidator per table described in schema (None for the others)"""
+    validators = []
+    for table, (path, fields) in zip(SCHEMA_TABLES, CSV_OUTPUTS):
+        rules = schema.get(table)
+        if rules is None:
+            validators.append(None)
+            continue
+        if rules.get('type') == 'list':
+            rules = rules['schema']
+        validators.append(TableValidator(table, fields, rules['schema']))
+    return validators
+
+
+class ValidationReport(object):
+    """Validation errors collected over a run instead of raised on the first one"""
+
+    def __init__(self, max_examples=20):
+        self.rows_checked = 0
+        self.invalid_rows = 0
+        self.error_counts = defaultdict(int)
+        self.examples = []
+        self.max_examples = max_examples
+
+    def check(self, validator, rows):
+        self.rows_checked += len(rows)
+        if validator.batch_is_valid(rows):
+            return
+        for row in rows:
+            errors = validator.row_errors(row)
+            if errors:
+                self.invalid_rows += 1
+                for field, message in errors:
+                    self.error_counts[(validator.table, field, message)] += 1
+                if len(self.examples) < self.max_examples:
+                    self.examples.append((validator.table, row, errors))
+
+    def merge(self, other):
+        self.rows_checked += other.rows_checked
+        self.invalid_rows += other.invalid_rows
+        for key, count in other.error_counts.iteritems():
+            self.error_counts[key] += count
+        self.examples.extend(other.examples[:self.max_examples - len(self.examples)])
+
+    def summary(self):
+        lines = ["{0} rows checked, {1} invalid".format(self.rows_checked, self.invalid_rows)]
+        for (table, field, message), count in sorted(self.error_counts.iteritems()):
+            lines.append("  {0}.{1}: {2} ({3} rows)".format(table, field, message, count))
+        for table, row, errors in self.examples:
+            lines.append("  e.g. {0} {1}: {2}".format(table, row, errors))
+        return "\n".join(lines)
+
+
+class ValidatingWriter(object):
+    """Holds rows back from a row writer until flush() has checked them
+
+    writerow/writerows are the pending list's own append/extend, so passing a
+    row through costs no more than a list append. Rows are written whether or
+    not they pass; problems end up in the report.
+    """
+
+    def __init__(self, writer, validator, report):
+        self.writer = writer
+        self.validator = validator
+        self.report = report
+        self.pending = []
+        self.writerow = self.pending.append
+        self.writerows = self.pending.extend
+
+    def flush(self):
+        if self.pending:
+            self.report.check(self.validator, self.pending)
+            self.writer.writerows(self.pending)
+            del self.pending[:]
+
+
+# Any of these at the start of an XML tag opens a new top level element
+ELEMENT_START = re.compile(r'<(node|way|relation)[\s/>]')
+SHARD_BLOCK = 1024 * 1024
+
+def next_element_start(f, offset):
+    """Return the offset of the first top level element at or after offset"""
+    f.seek(offset)
+    carry = ''
+    while True:
+        block = f.read(SHARD_BLOCK)
+        if not block:
+            return None
+        m = ELEMENT_START.search(carry + block)
+        if m:
+            return offset - len(carry) + m.start()
+        carry = block[-16:]
+        offset += len(block)
+
+def find_shards(file_in, shards):
+    """Split the .osm file into byte ranges that start at <node/<way/<relation"""
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as f:
+        first = next_element_start(f, 0)
+        f.seek(max(0, size - SHARD_BLOCK))
+        tail = f.read()
+        end = size - len(tail) + tail.rindex('</osm>')
+        if first is None or first >= end:
+            return []
+        offsets = [first]
+        for i in range(1, shards):
+            offset = next_element_start(f, first + (end - first) * i // shards)
+            if offset is not None and offsets[-1] < offset < end:
+                offsets.append(offset)
+    offsets.append(end)
+    return zip(offsets[:-1], offsets[1:])
+
+def read_shard(file_in, start, end):
+    """Yield the byte range [start, end) wrapped into a standalone OSM document"""
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n'
+    with open(file_in, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(SHARD_BLOCK, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    yield '</osm>'
+
+
+def insert_sql(table, fields, conflict=None):
+    """INSERT statement with one placeholder per field
+
+    conflict adds an ON CONFLICT clause, as in INSERT OR REPLACE.
+    """
+    verb = "INSERT OR {0}".format(conflict) if conflict else "INSERT"
+    return "{0} INTO {1} ({2}) VALUES ({3});".format(
+        verb, table, ", ".join(fields), ", ".join("?" * len(fields)))
+
+
+# Bulk-load profile: no fsync and a large page cache while the tables are
+# filled inside a single transaction, secondary indexes built once the rows
+# are in, then ANALYZE and the safe default settings restored.
+BULK_LOAD_PRAGMAS = ["PRAGMA synchronous=OFF",
+                     "PRAGMA cache_size=-200000",
+                     "PRAGMA temp_store=MEMORY"]
+SAFE_PRAGMAS = ["PRAGMA journal_mode=DELETE",
+                "PRAGMA synchronous=FULL",
+                "PRAGMA cache_size=-2000",
+                "PRAGMA temp_store=DEFAULT"]
+
+# Secondary indexes, created after the bulk load
+# Each one backs a filter or join used by the analysis queries
+SQL_INDEXES = [
+    "CREATE INDEX nodes_tags_key_value ON nodes_tags (key, value)",
+    "CREATE INDEX nodes_tags_id ON nodes_tags (id)",
+    "CREATE INDEX nodes_tags_type_key ON nodes_tags (type, key)",
+    "CREATE INDEX nodes_tags_value_id ON nodes_tags (value, id)",
+    "CREATE INDEX ways_tags_key_value ON ways_tags (key, value)",
+    "CREATE INDEX ways_tags_id ON ways_tags (id)",
+    "CREATE INDEX ways_tags_type_key ON ways_tags (type, key)",
+    "CREATE INDEX ways_nodes_node_id ON ways_nodes (node_id)",
+    "CREATE INDEX ways_nodes_id_position ON ways_nodes (id, position)",
+    "CREATE INDEX nodes_uid ON nodes (uid)",
+    "CREATE INDEX relation_tags_key_value ON relation_tags (key, value)",
+    "CREATE INDEX relation_tags_id ON relation_tags (id)",
+    "CREATE INDEX relation_members_id_position ON relation_members (id, position)",
+    "CREATE INDEX relation_members_type_ref ON relation_members (type, ref)",
+]
+
+def begin_bulk_load(conn, journal_mode='OFF'):
+    """Switch conn to the bulk-load settings and recreate the tables in a new transaction"""
+    conn.isolation_level = None
+    conn.execute("PRAGMA journal_mode={0}".format(journal_mode))
+    for pragma in BULK_LOAD_PRAGMAS:
+        conn.execute(pragma)
+    conn.execute("BEGIN")
+    for table, fields, create in SQL_TABLES:
+        conn.execute("DROP TABLE IF EXISTS {0}".format(table))
+        conn.execute(create)
+
+def end_bulk_load(conn):
+    """Build the indexes, commit, ANALYZE and restore the safe settings"""
+    for index in SQL_INDEXES:
+        conn.execute(index)
+    build_spatial_index(conn)
+    build_way_geometry(conn)
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+    for pragma in SAFE_PRAGMAS:
+        conn.execute(pragma)
+    conn.isolation_level = ''
+
+
+class SQLiteTableWriter(object):
+    """Stand-in for a CSV writer that inserts tuple rows into a SQLite table
+
+    Rows are buffered and sent with executemany() every batch_size rows,
+    so memory stays bounded however many rows the table ends up with.
+    """
+
+    def __init__(self, conn, table, fields, batch_size=10000):
+        self.conn = conn
+        self.fields = fields
+        self.batch_size = batch_size
+        self.buffer = []
+        self.sql = insert_sql(table, fields)
+
+    def writerow(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.conn.executemany(self.sql, self.buffer)
+            self.buffer = []
+
+
+class UnicodeWriter(object):
+    """csv.writer for tuple rows in fields order, encoding unicode values to utf-8"""
+
+    def __init__(self, f, fields):
+        self.writer = csv.writer(f)
+        self.fields = fields
+
+    def writeheader(self):
+        self.writer.writerow(self.fields)
+
+    def writerow(self, row):
+        self.writer.writerow([v.encode('utf-8') if isinstance(v, unicode) else v for v in row])
+
+    def writerows(self, rows):
+        self.writer.writerows([v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
+                              for row in rows)
+
+
 class UnicodeDictWriter(csv.DictWriter, object):
     """Extend csv.DictWriter to handle Unicode input"""
 
@@ -544,47 +2391,1262 @@ class UnicodeDictWriter(csv.DictWriter, object):
             self.writerow(row)
 
 
+# ================================================== #
+#               Columnar Export                      #
+# ================================================== #
+"""
+With columnar='parquet' (or 'arrow') process_map() also writes every table
+as a typed columnar file next to its CSV, nodes.parquet beside nodes.csv and
+so on, which pandas, pyarrow or DuckDB can memory-map and scan without
+parsing text. Ids and the other integer columns are int64, lat/lon float64
+and timestamps UTC timestamps. The rows are converted column by column and
+written every COLUMNAR_BATCH rows, one Parquet row group or Arrow record
+batch at a time, as the shaper produces them.
+
+In Parquet the repetitive text columns (tag keys and values, types, roles
+and user names) are dictionary-encoded. An Arrow IPC file holds a single
+dictionary per column for all of its batches, which is not known until
+the last row is shaped, so in .arrow files they are plain utf8 columns.
+"""
+COLUMNAR_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+COLUMNAR_BATCH = 64 * 1024
+
+# Column types by field name; every other field is text
+COLUMN_TYPES = {'id': 'int64', 'uid': 'int64', 'version': 'int64', 'changeset': 'int64',
+                'node_id': 'int64', 'ref': 'int64', 'position': 'int64',
+                'lat': 'float64', 'lon': 'float64', 'timestamp': 'timestamp'}
+DICTIONARY_FIELDS = frozenset(['user', 'key', 'value', 'type', 'role'])
+
+def columnar_path(path, columnar):
+    """Path of the columnar file written beside the CSV file at path"""
+    return os.path.splitext(path)[0] + COLUMNAR_FORMATS[columnar]
+
+
+def arrow_type(field, dictionary):
+    """Arrow type of a *_FIELDS column, dictionary-encoding the text columns that repeat"""
+    kind = COLUMN_TYPES.get(field)
+    if kind == 'int64':
+        return pa.int64()
+    elif kind == 'float64':
+        return pa.float64()
+    elif kind == 'timestamp':
+        # Parquet has no second resolution timestamps, milliseconds round-trip in both formats
+        return pa.timestamp('ms', tz='UTC')
+    elif dictionary and field in DICTIONARY_FIELDS:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def arrow_array(values, column_type):
+    """Arrow array of column_type from one column of shaped rows
+
+    Numbers and timestamps still in text form are parsed by an Arrow cast of
+    the whole column rather than one value at a time in Python.
+    """
+    if pa.types.is_dictionary(column_type):
+        return pa.array(values, type=pa.string()).dictionary_encode()
+    first = next((value for value in values if value is not None), None)
+    if isinstance(first, basestring) and not pa.types.is_string(column_type):
+        return pa.array(values, type=pa.string()).cast(column_type)
+    return pa.array(values, type=column_type)
+
+
+class ColumnarTableWriter(object):
+    """Stand-in for a CSV writer that writes tuple rows to a typed Parquet or Arrow file
+
+    Rows are buffered and every batch_size rows turned into one row group
+    (Parquet) or record batch (Arrow IPC file). close() writes the rest
+    and the file footer.
+    """
+
+    def __init__(self, path, fields, columnar='parquet', batch_size=COLUMNAR_BATCH):
+        if pa is None:
+            raise ImportError("columnar output needs the pyarrow package")
+        self.path = path
+        self.fields = fields
+        self.columnar = columnar
+        self.batch_size = batch_size
+        self.buffer = []
+        self.schema = pa.schema([pa.field(field, arrow_type(field, columnar == 'parquet'))
+                                 for field in fields])
+        if columnar == 'parquet':
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.RecordBatchFileWriter(path, self.schema)
+
+    def writerow(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            arrays = []
+            for field, values in zip(self.schema, zip(*self.buffer)):
+                try:
+                    arrays.append(arrow_array(values, field.type))
+                except ValueError as e:
+                    raise ValueError("{0}: bad {1} value ({2})".format(self.path, field.name, e))
+            self.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+            self.buffer = []
+
+    def write_batch(self, batch):
+        if self.columnar == 'parquet':
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def append_file(self, path):
+        """Copy the row groups or record batches of another file of this table, in order"""
+        if self.columnar == 'parquet':
+            dictionary = [field for field in self.fields if field in DICTIONARY_FIELDS]
+            part = pq.ParquetFile(path, read_dictionary=dictionary)
+            for i in range(part.num_row_groups):
+                self.writer.write_table(part.read_row_group(i))
+        else:
+            part = pa.ipc.open_file(pa.memory_map(path))
+            for i in range(part.num_record_batches):
+                self.writer.write_batch(part.get_batch(i))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class TeeWriter(object):
+    """Hands every row to each of several writers"""
+
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def writerow(self, row):
+        for writer in self.writers:
+            writer.writerow(row)
+
+    def writerows(self, rows):
+        # rows is read once per writer, so it has to be a list, not an iterator
+        for writer in self.writers:
+            writer.writerows(rows)
+
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
+CSV_OUTPUTS = [(NODES_PATH, NODE_FIELDS),
+               (NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+               (WAYS_PATH, WAY_FIELDS),
+               (WAY_NODES_PATH, WAY_NODES_FIELDS),
+               (WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+               (RELATIONS_PATH, RELATION_FIELDS),
+               (RELATION_MEMBERS_PATH, RELATION_MEMBERS_FIELDS),
+               (RELATION_TAGS_PATH, RELATION_TAGS_FIELDS)]
+
+# Top level elements shaped by process_map
+MAP_ELEMENTS = ('node', 'way', 'relation')
+
+# Caches process_map loads from and saves to its cache_path
+NORMALIZATION_CACHES = (clean_street_name, valid_zipcode)
+
+def process_map(file_in, validate, processes=1, db_path=None, batch_size=10000,
+                cache_path=None, parser='etree', columnar=None, area=None):
     """Iteratively process each XML element 
     into the correct dictionary format
     and then write to csv(s)
+
+    With processes > 1 the file is split into element-aligned shards
+    which are shaped in a process pool and concatenated back in order,
+    so the CSVs are byte-identical to the single process run.
+
+    With db_path set, the shaped rows skip the CSV files and are
+    streamed straight into the SQLite tables of that database instead.
+
+    With cache_path set, the street name and zipcode normalizations
+    saved by earlier runs are reused, and the updated caches are saved back.
+
+    With validate=True every row is checked against SCHEMA and the
+    ValidationReport listing any problems is returned.
+
+    parser picks the XML backend of get_element() ('etree', 'lxml' or 'expat').
+
+    With columnar set to 'parquet' or 'arrow', each table is also written as
+    a typed columnar file beside its CSV (see ColumnarTableWriter).
+
+    A file_in ending in .pbf is read with pbf_elements(), and a .bz2, .gz
+    or .xz file is decompressed as it is read. For those processes sets how
+    many processes decode the PBF blocks or bzip2 streams, and shaping stays
+    serial.
+
+    With area set (a bbox, WKT or GeoJSON, see parse_area()) only the part
+    of file_in inside it is shaped, kept referentially complete by
+    area_elements(). The file is then read twice and shaped serially.
+
+    file_in may also be an open file object holding .osm XML, which is
+    shaped serially whatever processes says.
+    """
+    # An open file object is read as it comes, it cannot be split into shards
+    path = isinstance(file_in, basestring)
+    pbf = path and file_in.endswith('.pbf')
+    streamed = not path or pbf or osm_compression(file_in) is not None or area is not None
+    if db_path is not None and processes > 1 and not streamed:
+        raise ValueError("Loading into SQLite runs in a single process")
+    if columnar is not None:
+        if columnar not in COLUMNAR_FORMATS:
+            raise ValueError("Unknown columnar format {0!r}, expected one of {1}".format(
+                columnar, ", ".join(sorted(COLUMNAR_FORMATS))))
+        if db_path is not None:
+            raise ValueError("Columnar files are written alongside the CSV files, not the database")
+
+    if cache_path is not None and os.path.exists(cache_path):
+        for cache in NORMALIZATION_CACHES:
+            cache.load(cache_path)
+
+    if pbf and area is not None:
+        elements = area_elements(lambda: pbf_elements(file_in, MAP_ELEMENTS, processes), area)
+    elif pbf:
+        elements = pbf_elements(file_in, MAP_ELEMENTS, processes)
+    else:
+        elements = get_element(file_in, tags=MAP_ELEMENTS, parser=parser, processes=processes,
+                               area=area)
+
+    if db_path is not None:
+        report = load_db(elements, validate, db_path, batch_size)
+    elif processes > 1 and not streamed:
+        report = process_map_parallel(file_in, validate, processes, parser, columnar)
+    else:
+        report = write_csvs(elements, validate, suffix='', header=True, columnar=columnar)
+
+    if cache_path is not None:
+        for cache in NORMALIZATION_CACHES:
+            cache.save(cache_path)
+    return report
+
+
+def process_map_parallel(file_in, validate, processes, parser='etree', columnar=None):
+    """Shape element-aligned byte ranges of file_in in a process pool
+
+    The normalization caches filled by the workers are merged back into
+    this process's, so they can be saved and their counts add up.
+    """
+    shards = find_shards(file_in, processes * 4)
+    jobs = [(file_in, start, end, validate, parser, columnar, '.part%d' % i)
+            for i, (start, end) in enumerate(shards)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(process_shard, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    reports = [report for report, cache_states in results]
+    for report, cache_states in results:
+        for cache, state in zip(NORMALIZATION_CACHES, cache_states):
+            cache.merge(*state)
+
+    # Headers first, then every shard appended in file order
+    write_csvs([], validate, suffix='', header=True)
+    for path, fields in CSV_OUTPUTS:
+        with open(path, 'ab') as out:
+            for job in jobs:
+                part = path + job[-1]
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+                os.remove(part)
+        if columnar is not None:
+            writer = ColumnarTableWriter(columnar_path(path, columnar), fields, columnar)
+            for job in jobs:
+                part = columnar_path(path, columnar) + job[-1]
+                writer.append_file(part)
+                os.remove(part)
+            writer.close()
+
+    if validate is True:
+        report = ValidationReport()
+        for shard_report in reports:
+            report.merge(shard_report)
+        return report
+
+
+def process_shard(job):
+    """Pool worker: shape one byte range into its own set of CSV parts
+
+    Returns the validation report and, for each of NORMALIZATION_CACHES,
+    its entries and the hits and misses counted for this shard.
     """
+    file_in, start, end, validate, parser, columnar, suffix = job
+    counts = [(cache.hits, cache.misses) for cache in NORMALIZATION_CACHES]
+    elements = get_element(ChunkReader(read_shard(file_in, start, end)), tags=MAP_ELEMENTS,
+                           parser=parser)
+    report = write_csvs(elements, validate, suffix=suffix, header=False, columnar=columnar)
+    return report, [(cache.entries(), cache.hits - hits, cache.misses - misses)
+                    for cache, (hits, misses) in zip(NORMALIZATION_CACHES, counts)]
+
+
+def load_db(elements, validate, db_path, batch_size):
+    """Shape elements and insert them into freshly created tables in one transaction"""
+    conn = sqlite3.connect(db_path)
+    try:
+        begin_bulk_load(conn)
+        writers = [SQLiteTableWriter(conn, table, fields, batch_size)
+                   for table, fields, create in SQL_TABLES]
+
+        report = write_elements(elements, validate, writers)
+        for writer in writers:
+            writer.flush()
+        end_bulk_load(conn)
+        return report
+    finally:
+        conn.close()
+
+
+def write_csvs(elements, validate, suffix, header, columnar=None,
+               buffer_size=OUTPUT_BUFFER, background=BACKGROUND_WRITES):
+    """Shape elements and write them to the CSV files of CSV_OUTPUTS (plus suffix)
+
+    With columnar set the rows also go to the matching columnar files.
+    The CSV files are written in buffer_size chunks, by a BackgroundWriter
+    thread when background is true; buffer_size=None writes straight to
+    the files instead.
+    """
+    background_writer = BackgroundWriter() if background and buffer_size else None
+    files = [codecs.open(path + suffix, 'w') for path, fields in CSV_OUTPUTS]
+    if buffer_size:
+        files = [BufferedOutput(f, buffer_size, background_writer) for f in files]
+    columnar_writers = []
+    written = False
+    try:
+        writers = [UnicodeWriter(f, fields) for f, (path, fields) in zip(files, CSV_OUTPUTS)]
+
+        if header:
+            for writer in writers:
+                writer.writeheader()
+
+        if columnar is not None:
+            for path, fields in CSV_OUTPUTS:
+                columnar_writers.append(ColumnarTableWriter(
+                    columnar_path(path, columnar) + suffix, fields, columnar))
+            writers = [TeeWriter(writer, columnar_writer)
+                       for writer, columnar_writer in zip(writers, columnar_writers)]
+
+        report = write_elements(elements, validate, writers)
+        for writer in columnar_writers:
+            writer.close()
+        written = True
+        return report
+    finally:
+        for f in files:
+            f.close()
+        if background_writer is not None:
+            background_writer.close(check=written)
+
+
+def write_elements(elements, validate, writers):
+    """Shape each element and hand its tuple rows to the matching writers
+
+    writers are in CSV_OUTPUTS/SQL_TABLES order. With validate=True the rows
+    are checked against SCHEMA on the way and the ValidationReport is returned.
+    """
+    report = None
+    validating = []
+    if validate is True:
+        report = ValidationReport()
+        writers = [ValidatingWriter(writer, validator, report) if validator else writer
+                   for writer, validator in zip(writers, compile_schema())]
+        validating = [writer for writer in writers if isinstance(writer, ValidatingWriter)]
+
+    (nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer,
+     relations_writer, relation_members_writer, relation_tags_writer) = writers
+
+    for count, element in enumerate(elements, 1):
+        if validating and not count % VALIDATION_BATCH:
+            for writer in validating:
+                writer.flush()
+        shaped = shape_rows(element)
+        if shaped:
+            row, tags, refs = shaped
+            if element.tag == 'node':
+                nodes_writer.writerow(row)
+                node_tags_writer.writerows(tags)
+            elif element.tag == 'way':
+                ways_writer.writerow(row)
+                way_nodes_writer.writerows(refs)
+                way_tags_writer.writerows(tags)
+            elif element.tag == 'relation':
+                relations_writer.writerow(row)
+                relation_members_writer.writerows(refs)
+                relation_tags_writer.writerows(tags)
+
+    for writer in validating:
+        writer.flush()
+    return report
+
+# ================================================== #
+#               Incremental Updates                  #
+# ================================================== #
+"""
+A daily OsmChange (.osc, often .osc.gz) file lists the elements created,
+modified and deleted since the last replication state. apply_osc() applies
+one to an existing database instead of rebuilding it from the full extract:
+every created or modified element goes through shape_rows(), so it is
+cleaned exactly like a full load, and replaces the element's main row and
+all of its tag, way node or member rows. Changes that are not newer than
+the version already in the database are skipped, so applying a diff twice
+is harmless. The replication sequence number of the last diff applied is
+kept in the replication_state table.
+"""
+# main table, tags table and reference table of each element type
+ELEMENT_TABLES = {'node': ('nodes', 'nodes_tags', None),
+                  'way': ('ways', 'ways_tags', 'ways_nodes'),
+                  'relation': ('relations', 'relation_tags', 'relation_members')}
+TABLE_FIELDS = dict((table, fields) for table, fields, create in SQL_TABLES)
+OSC_ACTIONS = ('create', 'modify', 'delete')
+REPLICATION_STATE_TABLE = "CREATE TABLE IF NOT EXISTS replication_state \
+    (key TEXT PRIMARY KEY, value TEXT)"
+
+def osc_changes(osc_file):
+    """Yield (action, element) for every node, way and relation of an OsmChange file"""
+    action = None
+    context = iter(ET.iterparse(osm_input(osc_file), events=('start', 'end')))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in OSC_ACTIONS:
+                action = elem.tag
+        elif elem.tag in ELEMENT_TABLES:
+            if action is None:
+                raise ValueError("{0} {1} is outside any create, modify or delete block".format(
+                    elem.tag, elem.attrib.get('id')))
+            yield action, elem
+            root.clear()
 
-    with codecs.open(NODES_PATH, 'w') as nodes_file,          codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file,          codecs.open(WAYS_PATH, 'w') as ways_file,          codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file,          codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
 
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+def read_replication_state(state_file):
+    """Dict of the key=value lines of a replication state.txt file"""
+    state = {}
+    with open(state_file) as f:
+        for line in f:
+            if '=' in line and not line.startswith('#'):
+                key, value = line.strip().split('=', 1)
+                state[key] = value.replace('\\:', ':')
+    return state
 
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
 
-        validator = cerberus.Validator()
+def replication_sequence(conn):
+    """Sequence number of the last diff applied to conn, or None"""
+    row = conn.execute("SELECT value FROM replication_state WHERE key = 'sequenceNumber'").fetchone()
+    return int(row[0]) if row else None
+
+
+def apply_change(conn, action, element, rtree=False):
+    """Apply one OsmChange action; return the action, or 'stale' if it was skipped
+
+    rtree=True keeps the nodes_rtree spatial index in step with the nodes table.
+    """
+    main_table, tags_table, refs_table = ELEMENT_TABLES[element.tag]
+    element_id = int(element.attrib['id'])
+    version = int(element.attrib.get('version', 0))
+
+    current = conn.execute("SELECT version FROM {0} WHERE id = ?".format(main_table),
+                           (element_id,)).fetchone()
+    if current is None:
+        if action == 'delete':
+            return 'stale'
+    elif current[0] is not None:
+        if current[0] > version or (current[0] == version and action != 'delete'):
+            return 'stale'
+
+    for table in (tags_table, refs_table):
+        if table is not None:
+            conn.execute("DELETE FROM {0} WHERE id = ?".format(table), (element_id,))
+    if rtree and element.tag == 'node':
+        conn.execute("DELETE FROM nodes_rtree WHERE id = ?", (element_id,))
+    if action == 'delete':
+        conn.execute("DELETE FROM {0} WHERE id = ?".format(main_table), (element_id,))
+        return action
+
+    row, tags, refs = shape_rows(element)
+    conn.execute(insert_sql(main_table, TABLE_FIELDS[main_table], conflict='REPLACE'), row)
+    if rtree and element.tag == 'node' and row[1] is not None:
+        conn.execute("INSERT INTO nodes_rtree VALUES (?, ?, ?, ?, ?)",
+                     (element_id, row[1], row[1], row[2], row[2]))
+    conn.executemany(insert_sql(tags_table, TABLE_FIELDS[tags_table]), tags)
+    if refs_table is not None:
+        conn.executemany(insert_sql(refs_table, TABLE_FIELDS[refs_table]), refs)
+    return action
+
+
+def apply_osc(osc_file, db_path, state=None):
+    """Apply an OsmChange file to the database at db_path in one transaction
+
+    state is the diff's replication state (see read_replication_state()).
+    Its sequenceNumber is recorded with the changes, and a diff whose
+    sequence number was already applied is skipped. Returns a dict counting
+    the creates, modifies, deletes and stale changes, or None if skipped.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(REPLICATION_STATE_TABLE)
+        sequence = int(state['sequenceNumber']) if state else None
+        applied = replication_sequence(conn)
+        if sequence is not None and applied is not None and sequence <= applied:
+            return None
+
+        counts = dict.fromkeys(OSC_ACTIONS + ('stale',), 0)
+        rtree = table_exists(conn, 'nodes_rtree')
+        geometry = table_exists(conn, 'way_geometry')
+        ways = set()
+        with conn:
+            for action, element in osc_changes(osc_file):
+                applied = apply_change(conn, action, element, rtree)
+                counts[applied] += 1
+                if geometry and applied != 'stale':
+                    ways.update(changed_ways(conn, element))
+            update_way_geometry(conn, sorted(ways))
+            if state:
+                conn.executemany("INSERT OR REPLACE INTO replication_state (key, value) VALUES (?, ?)",
+                                 state.items())
+        return counts
+    finally:
+        conn.close()
 
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+
+# ================================================== #
+#               Spatial Queries                      #
+# ================================================== #
+"""
+nodes_rtree is an SQLite R*Tree over the node coordinates. It is filled by
+build_spatial_index() at the end of every bulk load and kept current by
+apply_osc(). bbox_nodes(), nodes_within() and nearest_nodes() find nodes in
+a box, within a distance, or the k nearest, optionally only those with a
+nodes_tags key (and value). They read the R*Tree instead of scanning
+nodes; on an SQLite built without the R*Tree module they fall back to a
+scan. Boxes do not wrap around the 180th meridian.
+"""
+NODES_RTREE = "CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+EARTH_RADIUS = 6371008.8  # metres
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+NEAREST_START_RADIUS = 500
+
+def table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def build_spatial_index(conn):
+    """(Re)create nodes_rtree from the nodes table; False if SQLite has no R*Tree module"""
+    try:
+        conn.execute("DROP TABLE IF EXISTS nodes_rtree")
+        conn.execute(NODES_RTREE)
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes \
+        WHERE lat IS NOT NULL AND lon IS NOT NULL")
+    return True
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great circle distance in metres (haversine)"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_box(lat, lon, radius):
+    """(min_lon, min_lat, max_lon, max_lat) of a box holding every point within radius metres"""
+    dlat = radius / METRES_PER_DEGREE
+    dlon = min(radius / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-9)), 360.0)
+    return lon - dlon, lat - dlat, lon + dlon, lat + dlat
+
+
+def bbox_nodes(conn, min_lon, min_lat, max_lon, max_lat, key=None, value=None):
+    """(id, lat, lon) of the nodes in the box, optionally only those tagged key (= value)
+
+    value may be a single value or a list, e.g. ['restaurant', 'fast_food', 'cafe'].
+    """
+    box = [min_lat, max_lat, min_lon, max_lon]
+    if table_exists(conn, 'nodes_rtree'):
+        # The R*Tree stores 32-bit floats rounded outwards, so it selects the
+        # candidates and the exact coordinates in nodes decide
+        sql = "SELECT n.id, n.lat, n.lon FROM nodes_rtree r CROSS JOIN nodes n ON n.id = r.id \
+            WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ? \
+            AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?"
+        params = box + box
+    else:
+        sql = "SELECT n.id, n.lat, n.lon FROM nodes n WHERE n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?"
+        params = box
+    if key is not None:
+        sql += " AND EXISTS (SELECT 1 FROM nodes_tags t WHERE t.id = n.id AND t.key = ?"
+        params.append(key)
+        if value is not None:
+            values = [value] if isinstance(value, basestring) else list(value)
+            sql += " AND t.value IN ({0})".format(", ".join(["?"] * len(values)))
+            params.extend(values)
+        sql += ")"
+    return conn.execute(sql, params).fetchall()
+
+
+def nodes_within(conn, lat, lon, radius, key=None, value=None):
+    """(distance in metres, id, lat, lon) of the nodes within radius metres, nearest first"""
+    found = []
+    for node_id, node_lat, node_lon in bbox_nodes(conn, *radius_box(lat, lon, radius),
+                                                  key=key, value=value):
+        node_distance = distance(lat, lon, node_lat, node_lon)
+        if node_distance <= radius:
+            found.append((node_distance, node_id, node_lat, node_lon))
+    found.sort()
+    return found
+
+
+def nearest_nodes(conn, lat, lon, k, key=None, value=None):
+    """The k nearest nodes as (distance in metres, id, lat, lon), nearest first
+
+    The search radius starts at NEAREST_START_RADIUS metres and grows until
+    k nodes are within it, so nodes further than the radius are never missed.
+    """
+    radius = NEAREST_START_RADIUS
+    while True:
+        found = nodes_within(conn, lat, lon, radius, key, value)
+        if len(found) >= k or radius >= math.pi * EARTH_RADIUS:
+            return found[:k]
+        radius *= 4
+
+
+# ================================================== #
+#               Node Location Stores                 #
+# ================================================== #
+"""
+Resolving way node refs needs id -> (lat, lon) for every node, which a dict
+of tuples holds at a few hundred bytes a node. The stores below keep
+coordinates as int32 in 1e-7 degrees and share add(node_id, lat, lon), with
+ids in ascending order, get(node_id) -> (lat, lon) in 1e-7 degrees or None,
+nbytes() and close():
+
+NodeLocationArray     sorted arrays in memory, binary search, 16 bytes a node
+SparseNodeLocations   the same records in a file, searched through mmap
+DenseNodeLocations    a file indexed by node id, 8 bytes for every id up to
+                      the largest, so lookups are a single read
+
+node_location_store() picks one by extract size. The files are scratch
+space and close() removes them.
+"""
+NODE_LOCATIONS_PATH = "node_locations.bin"
+COORDINATE_SCALE = 10 ** 7
+IN_MEMORY_NODES = 20 * 1000 * 1000  # about 320 MB of arrays
+SPARSE_INDEX_STEP = 4096
+NODE_RECORD = struct.Struct('<dii')
+DENSE_SLOT = struct.Struct('<ii')
+# Dense lat values are stored 90 degrees and one unit up, so they are all
+# positive and a never written, zero slot means no node
+DENSE_LAT_OFFSET = 90 * COORDINATE_SCALE + 1
+
+def scaled_coordinate(value):
+    return int(round(value * COORDINATE_SCALE))
+
+
+class NodeLocationArray(object):
+    """Node coordinates in id order in memory, found with a binary search
+
+    ids are kept in an array of doubles (exact up to 2**53, and unlike a
+    64-bit integer typecode available on every platform), lat/lon as int32.
+    """
+
+    def __init__(self):
+        self.ids = array('d')
+        self.lats = array('i')
+        self.lons = array('i')
+
+    def add(self, node_id, lat, lon):
+        if self.ids and node_id <= self.ids[-1]:
+            raise ValueError("Node {0} added after node {1}, ids must ascend".format(
+                node_id, int(self.ids[-1])))
+        self.ids.append(node_id)
+        self.lats.append(scaled_coordinate(lat))
+        self.lons.append(scaled_coordinate(lon))
+
+    def get(self, node_id):
+        i = bisect_left(self.ids, node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return self.lats[i], self.lons[i]
+        return None
+
+    def nbytes(self):
+        return sum(a.buffer_info()[1] * a.itemsize for a in (self.ids, self.lats, self.lons))
+
+    def close(self):
+        pass
+
+
+class SparseNodeLocations(object):
+    """NodeLocationArray records (double id, int32 lat, int32 lon) in a file
+
+    add() appends to the file and the first get() maps it. Every
+    SPARSE_INDEX_STEP-th id is also kept in memory, so a lookup only
+    binary-searches one block of the file.
+    """
+
+    def __init__(self, path=NODE_LOCATIONS_PATH):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.index = array('d')
+        self.count = 0
+        self.last_id = None
+        self.map = None
+
+    def add(self, node_id, lat, lon):
+        if self.last_id is not None and node_id <= self.last_id:
+            raise ValueError("Node {0} added after node {1}, ids must ascend".format(
+                node_id, self.last_id))
+        if not self.count % SPARSE_INDEX_STEP:
+            self.index.append(node_id)
+        self.file.write(NODE_RECORD.pack(node_id, scaled_coordinate(lat), scaled_coordinate(lon)))
+        self.count += 1
+        self.last_id = node_id
+
+    def get(self, node_id):
+        if self.map is None:
+            if not self.count:
+                return None
+            self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), self.count * NODE_RECORD.size)
+        block = bisect_right(self.index, node_id) - 1
+        if block < 0:
+            return None
+        low = block * SPARSE_INDEX_STEP
+        high = min(low + SPARSE_INDEX_STEP, self.count)
+        unpack, buf, size = NODE_RECORD.unpack_from, self.map, NODE_RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            middle_id, lat, lon = unpack(buf, middle * size)
+            if middle_id < node_id:
+                low = middle + 1
+            elif middle_id > node_id:
+                high = middle
+            else:
+                return lat, lon
+        return None
+
+    def nbytes(self):
+        return self.count * NODE_RECORD.size + self.index.buffer_info()[1] * self.index.itemsize
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+        os.remove(self.path)
+
+
+class DenseNodeLocations(object):
+    """Node coordinates in a memory-mapped file at offset 8 * node id
+
+    The file grows with truncate(), so on filesystems with sparse files
+    the runs of unused ids take no disk space.
+    """
+
+    def __init__(self, path=NODE_LOCATIONS_PATH, capacity=1 << 20):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.map = None
+        self.capacity = 0
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(capacity * DENSE_SLOT.size)
+        self.map = mmap.mmap(self.file.fileno(), capacity * DENSE_SLOT.size)
+        self.capacity = capacity
+
+    def add(self, node_id, lat, lon):
+        if node_id < 0:
+            raise ValueError("Node {0}: a dense store only holds positive ids".format(node_id))
+        if node_id >= self.capacity:
+            self.resize(max(node_id + 1, self.capacity * 2))
+        DENSE_SLOT.pack_into(self.map, node_id * DENSE_SLOT.size,
+                             scaled_coordinate(lat) + DENSE_LAT_OFFSET, scaled_coordinate(lon))
+
+    def get(self, node_id):
+        if not 0 <= node_id < self.capacity:
+            return None
+        lat, lon = DENSE_SLOT.unpack_from(self.map, node_id * DENSE_SLOT.size)
+        if not lat:
+            return None
+        return lat - DENSE_LAT_OFFSET, lon
+
+    def nbytes(self):
+        """Bytes the file takes on disk (its full size where st_blocks is unknown)"""
+        stat = os.fstat(self.file.fileno())
+        blocks = getattr(stat, 'st_blocks', None)
+        return blocks * 512 if blocks is not None else stat.st_size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+        os.remove(self.path)
+
+
+NODE_STORES = {'array': NodeLocationArray,
+               'sparse': SparseNodeLocations,
+               'dense': DenseNodeLocations}
+
+def node_location_store(node_count, max_node_id, path=NODE_LOCATIONS_PATH):
+    """The node location store for an extract of node_count nodes with ids up to max_node_id
+
+    Up to IN_MEMORY_NODES the in-memory arrays. Beyond that the dense file,
+    whose lookups are a single read, if its 8 bytes per possible id are no
+    more than twice the 16 bytes per node of the sparse file (at least a
+    quarter of the ids are used, as in a planet file), else the sparse file.
+    """
+    if node_count <= IN_MEMORY_NODES:
+        return NodeLocationArray()
+    elif max_node_id * DENSE_SLOT.size <= 2 * node_count * NODE_RECORD.size:
+        return DenseNodeLocations(path, max_node_id + 1)
+    return SparseNodeLocations(path)
+
+
+# ================================================== #
+#               Way Geometry                         #
+# ================================================== #
+"""
+way_geometry holds what length and area reports need from each way's
+coordinates, assembled once after loading instead of joining ways ->
+ways_nodes -> nodes at query time: the bbox, the haversine length in
+metres, whether the way is closed and whether it is an area, and the
+points themselves as a blob of little-endian int32 lat/lon pairs in
+1e-7 degrees (see way_points()). The bulk build reads ways_nodes once in
+(id, position) order and looks every node up in a node location store.
+Nodes missing from the extract are left out of the geometry, so the
+length bridges the gap, and counted in missing. apply_osc() recomputes
+the rows of the ways a diff touches.
+"""
+WAY_GEOMETRY_FIELDS = ['id', 'min_lat', 'max_lat', 'min_lon', 'max_lon', 'length',
+                       'closed', 'area', 'points', 'missing', 'geometry']
+WAY_GEOMETRY_TABLE = "CREATE TABLE way_geometry \
+    (id INTEGER PRIMARY KEY, min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL, \
+    length REAL, closed INTEGER, area INTEGER, points INTEGER, missing INTEGER, geometry BLOB, \
+    FOREIGN KEY (id) REFERENCES ways (id))"
+# A closed way is an area when tagged area=yes or with one of these keys, unless area=no
+AREA_KEYS = frozenset(['building', 'landuse', 'amenity', 'leisure', 'natural', 'shop',
+                       'tourism', 'man_made', 'place', 'historic', 'military', 'aeroway'])
+
+def is_area(refs, tags):
+    """Whether a way with these node refs and {key: value} tags is an area"""
+    if len(refs) < 4 or refs[0] != refs[-1]:
+        return False
+    if 'area' in tags:
+        return tags['area'] != 'no'
+    return any(key in AREA_KEYS for key in tags)
+
+
+def way_geometry_row(way_id, refs, locations, tags):
+    """way_geometry row of a way from its node refs, looked up in locations"""
+    points = array('i')
+    missing = 0
+    for ref in refs:
+        location = locations.get(ref)
+        if location is None:
+            missing += 1
+        else:
+            points.extend(location)
+
+    lats, lons = points[0::2], points[1::2]
+    length = 0.0
+    if len(points) > 2:
+        radians = math.pi / 180 / COORDINATE_SCALE
+        phi = [lat * radians for lat in lats]
+        lam = [lon * radians for lon in lons]
+        cos_phi = map(math.cos, phi)
+        for i in range(1, len(phi)):
+            a = math.sin((phi[i] - phi[i - 1]) / 2) ** 2 + \
+                cos_phi[i - 1] * cos_phi[i] * math.sin((lam[i] - lam[i - 1]) / 2) ** 2
+            length += 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+    if sys.byteorder == 'big':
+        points.byteswap()
+    closed = len(refs) > 2 and refs[0] == refs[-1]
+    bbox = ((float(min(lats)) / COORDINATE_SCALE, float(max(lats)) / COORDINATE_SCALE,
+             float(min(lons)) / COORDINATE_SCALE, float(max(lons)) / COORDINATE_SCALE)
+            if points else (None, None, None, None))
+    return ((way_id,) + bbox + (length, int(closed), int(is_area(refs, tags)),
+                                len(lats), missing, sqlite3.Binary(points.tostring())))
+
+
+def way_points(geometry):
+    """[(lat, lon), ...] of a way_geometry blob"""
+    points = array('i', str(geometry))
+    if sys.byteorder == 'big':
+        points.byteswap()
+    return [(float(lat) / COORDINATE_SCALE, float(lon) / COORDINATE_SCALE)
+            for lat, lon in zip(points[0::2], points[1::2])]
+
+
+def way_area_tags(conn, way_id=None):
+    """{way id: {key: value}} of the tags is_area() looks at, for one way or all of them"""
+    keys = sorted(AREA_KEYS | set(['area']))
+    sql = "SELECT id, key, value FROM ways_tags WHERE type = 'regular' AND key IN ({0})".format(
+        ", ".join(["?"] * len(keys)))
+    params = keys
+    if way_id is not None:
+        sql += " AND id = ?"
+        params = keys + [way_id]
+    tags = defaultdict(dict)
+    for tag_way_id, key, value in conn.execute(sql, params):
+        tags[tag_way_id][key] = value
+    return tags
+
+
+def build_way_geometry(conn, store=None):
+    """(Re)create way_geometry and fill it for every way with nodes
+
+    store names one of NODE_STORES to hold the node coordinates; by
+    default node_location_store() picks one for the number of nodes.
+    """
+    conn.execute("DROP TABLE IF EXISTS way_geometry")
+    conn.execute(WAY_GEOMETRY_TABLE)
+    if store is None:
+        node_count, max_node_id = conn.execute("SELECT COUNT(*), MAX(id) FROM nodes").fetchone()
+        locations = node_location_store(node_count, max_node_id or 0)
+    else:
+        locations = NODE_STORES[store]()
+    try:
+        for node_id, lat, lon in conn.execute("SELECT id, lat, lon FROM nodes \
+                WHERE lat IS NOT NULL AND lon IS NOT NULL ORDER BY id"):
+            locations.add(node_id, lat, lon)
+        tags = way_area_tags(conn)
+        refs = conn.execute("SELECT id, node_id FROM ways_nodes ORDER BY id, position")
+        conn.executemany(insert_sql('way_geometry', WAY_GEOMETRY_FIELDS),
+                         (way_geometry_row(way_id, [ref for _, ref in way_refs], locations,
+                                           tags.get(way_id, {}))
+                          for way_id, way_refs in itertools.groupby(refs, itemgetter(0))))
+    finally:
+        locations.close()
+
+
+def changed_ways(conn, element):
+    """Ids of the ways whose geometry a changed node or way affects"""
+    if element.tag == 'way':
+        return [int(element.attrib['id'])]
+    elif element.tag == 'node':
+        return [way_id for way_id, in conn.execute(
+            "SELECT DISTINCT id FROM ways_nodes WHERE node_id = ?", (int(element.attrib['id']),))]
+    return []
+
+
+def update_way_geometry(conn, way_ids):
+    """Recompute the way_geometry rows of way_ids from the current tables"""
+    for way_id in way_ids:
+        conn.execute("DELETE FROM way_geometry WHERE id = ?", (way_id,))
+        refs = []
+        locations = {}
+        for ref, lat, lon in conn.execute("SELECT w.node_id, n.lat, n.lon FROM ways_nodes w \
+                LEFT JOIN nodes n ON n.id = w.node_id WHERE w.id = ? ORDER BY w.position", (way_id,)):
+            refs.append(ref)
+            if lat is not None and lon is not None:
+                locations[ref] = (scaled_coordinate(lat), scaled_coordinate(lon))
+        if refs:
+            conn.execute(insert_sql('way_geometry', WAY_GEOMETRY_FIELDS), way_geometry_row(
+                way_id, refs, locations, way_area_tags(conn, way_id).get(way_id, {})))
+
+
+# ================================================== #
+#               Integrity Check                      #
+# ================================================== #
+"""
+SQLite does not enforce the FOREIGN KEY clauses of SQL_TABLES, and a
+sampled or cut extract leaves ways pointing at nodes it does not hold.
+check_integrity() finds every such reference in the CSV files without a
+database: for each check in INTEGRITY_CHECKS the referencing rows and the
+referenced ids are each put in key order by external_sort(), which sorts
+SORT_RUN_SIZE records at a time in memory and spills them to temporary
+files as runs to merge, and a single merge-join over the two sorted
+streams finds the references with no match. Memory stays bounded by the
+run size whatever the size of the files.
+"""
+SORT_RUN_SIZE = 1000000
+SORT_BLOCK = 8192
+INTEGRITY_REPORT_PATH = "integrity_report.csv"
+INTEGRITY_REPORT_FIELDS = ['check', 'line', 'id', 'ref']
+
+# (name, referencing CSV, its column, referenced CSV, its column)
+INTEGRITY_CHECKS = [
+    ('ways_nodes.node_id', WAY_NODES_PATH, 'node_id', NODES_PATH, 'id'),
+    ('ways_nodes.id', WAY_NODES_PATH, 'id', WAYS_PATH, 'id'),
+    ('nodes_tags.id', NODE_TAGS_PATH, 'id', NODES_PATH, 'id'),
+    ('ways_tags.id', WAY_TAGS_PATH, 'id', WAYS_PATH, 'id'),
+    ('relation_members.id', RELATION_MEMBERS_PATH, 'id', RELATIONS_PATH, 'id'),
+    ('relation_tags.id', RELATION_TAGS_PATH, 'id', RELATIONS_PATH, 'id'),
+]
+
+def read_run(run, record):
+    """Yield the records of a spilled run, reading SORT_BLOCK of them at a time"""
+    width = record.size // 8
+    while True:
+        data = run.read(SORT_BLOCK * record.size)
+        if not data:
+            return
+        values = iter(struct.unpack('<%dq' % (len(data) // 8), data))
+        for values_record in zip(*[values] * width):
+            yield values_record
+
+
+def external_sort(records, width, run_size=SORT_RUN_SIZE):
+    """Yield records, tuples of width integers, in sorted order using bounded memory
+
+    Input that fits in one run is sorted in memory; otherwise each run is
+    written as little-endian int64s to a temporary file and the runs are
+    merged with heapq.merge().
+    """
+    records = iter(records)
+    record = struct.Struct('<%dq' % width)
+    runs = []
+    try:
+        while True:
+            chunk = list(itertools.islice(records, run_size))
+            chunk.sort()
+            if not runs and len(chunk) < run_size:
+                for sorted_record in chunk:
+                    yield sorted_record
+                return
+            if not chunk:
+                break
+            run = tempfile.TemporaryFile()
+            for i in range(0, len(chunk), SORT_BLOCK):
+                run.write(''.join([record.pack(*r) for r in chunk[i:i + SORT_BLOCK]]))
+            run.seek(0)
+            runs.append(run)
+            del chunk
+        for sorted_record in heapq.merge(*[read_run(run, record) for run in runs]):
+            yield sorted_record
+    finally:
+        for run in runs:
+            run.close()
+
+
+def csv_references(path, column):
+    """Yield (value of column, id column, line number) for each row of a CSV with a value there"""
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        key, element_id = header.index(column), header.index('id')
+        for line, row in enumerate(reader, 2):
+            if row[key]:
+                yield int(row[key]), int(row[element_id]), line
+
+
+def csv_ids(path, column):
+    """Yield the values of column of a CSV file as 1-tuples of int"""
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        key = next(reader).index(column)
+        for row in reader:
+            if row[key]:
+                yield (int(row[key]),)
+
+
+def dangling(references, ids):
+    """References (key, ...) whose key is not in ids; both iterables in key order"""
+    ids = iter(ids)
+    current = next(ids, None)
+    for reference in references:
+        while current is not None and current[0] < reference[0]:
+            current = next(ids, None)
+        if current is None or current[0] != reference[0]:
+            yield reference
+
+
+def check_integrity(report_path=INTEGRITY_REPORT_PATH, checks=INTEGRITY_CHECKS,
+                    run_size=SORT_RUN_SIZE):
+    """Write every dangling reference in the CSV files to report_path; return counts per check
+
+    Each report row is the check, the line of the referencing CSV, that
+    row's id and the missing id it refers to.
+    """
+    counts = {}
+    with open(report_path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(INTEGRITY_REPORT_FIELDS)
+        for name, path, column, referenced_path, referenced_column in checks:
+            counts[name] = 0
+            references = external_sort(csv_references(path, column), 3, run_size)
+            ids = external_sort(csv_ids(referenced_path, referenced_column), 1, run_size)
+            for ref, element_id, line in dangling(references, ids):
+                writer.writerow([name, line, element_id, ref])
+                counts[name] += 1
+    return counts
+
+
+# Everything the CSV files depend on: the extract, the street mapping, the code
+# reading and shaping the elements, and the patterns and field lists it uses
+SHAPING_CODE = [shape_rows, shape_tag, row_dict, NormalizationCache, compile_mapping, street_normalizer,
+                process_map, process_map_parallel, process_shard, find_shards, read_shard,
+                next_element_start, get_element, etree_elements, lxml_elements, expat_elements,
+                OSMRecord, pbf_elements, decode_pbf_block, pbf_element, pbf_dense_nodes,
+                write_elements, write_csvs, ValidatingWriter, UnicodeWriter, TeeWriter,
+                ColumnarTableWriter, arrow_type, arrow_array,
+                area_elements, parse_area, Area, IdBitmap, BufferedOutput, BackgroundWriter]
+SHAPING_VALUES = [LOWER_COLON.pattern, PROBLEMCHARS.pattern, ELEMENT_START.pattern,
+                  CSV_OUTPUTS, MAP_ELEMENTS, sorted(OSM_CHILD_TAGS), sorted(COLUMN_TYPES.items()),
+                  sorted(DICTIONARY_FIELDS)]
+CSV_PATHS = [path for path, fields in CSV_OUTPUTS]
+
+# Typed copies of the tables for pandas/DuckDB: None, 'parquet' or 'arrow'
+# (needs pyarrow). Off by default, since they add a second copy of every table.
+COLUMNAR = None
+COLUMNAR_PATHS = [columnar_path(path, COLUMNAR) for path in CSV_PATHS] if COLUMNAR else []
+
+# Whether to list the references the CSV files leave dangling (see check_integrity())
+CHECK_INTEGRITY = True
+INTEGRITY_CODE = [check_integrity, external_sort, read_run, csv_references, csv_ids, dangling]
 
 if __name__ == '__main__':
-    process_map(OSM_PATH, validate = False)
+    csv_inputs = {'osm': build_manifest.file_digest(OSM_PATH), 'mapping': value_digest(mapping),
+                  'code': code_digest(SHAPING_CODE), 'values': value_digest(SHAPING_VALUES),
+                  'columnar': COLUMNAR,
+                  'area': build_manifest.file_digest(AREA) if isinstance(AREA, basestring) and os.path.exists(AREA)
+                          else value_digest(AREA)}
+    if build_manifest.stale('csv', csv_inputs, CSV_PATHS + COLUMNAR_PATHS):
+        validation_report = process_map(OSM_PATH, validate = True, cache_path = "normalization_cache.db",
+                                        columnar = COLUMNAR, area = AREA)
+        print validation_report.summary()
+        build_manifest.record('csv', csv_inputs)
+    else:
+        print "CSV files are up to date"
+
+    if CHECK_INTEGRITY:
+        integrity_inputs = {'csv': [build_manifest.file_digest(path) for path in CSV_PATHS],
+                            'checks': value_digest(INTEGRITY_CHECKS), 'code': code_digest(INTEGRITY_CODE)}
+        if build_manifest.stale('integrity', integrity_inputs, [INTEGRITY_REPORT_PATH]):
+            for name, count in sorted(check_integrity().items()):
+                print "Dangling %s references: %d" % (name, count)
+            print "Listed in", INTEGRITY_REPORT_PATH
+            build_manifest.record('integrity', integrity_inputs)
+        else:
+            print "Integrity report is up to date"
+
+
+# In[ ]:
+
+# Ingest speed of the two row models on the sample file:
+# a dict per row through DictWriter vs. a tuple per row through csv.writer
+def time_dict_rows(file_in):
+    """Shape every element to dicts and write them to os.devnull; return (rows, seconds)"""
+    rows = 0
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        writers = dict((path, UnicodeDictWriter(devnull, fields)) for path, fields in CSV_OUTPUTS)
+        for element in get_element(file_in, tags=('node', 'way')):
+            el = shape_element(element)
+            if element.tag == 'node':
+                writers[NODES_PATH].writerow(el['node'])
+                writers[NODE_TAGS_PATH].writerows(el['node_tags'])
+                rows += 1 + len(el['node_tags'])
+            elif element.tag == 'way':
+                writers[WAYS_PATH].writerow(el['way'])
+                writers[WAY_NODES_PATH].writerows(el['way_nodes'])
+                writers[WAY_TAGS_PATH].writerows(el['way_tags'])
+                rows += 1 + len(el['way_nodes']) + len(el['way_tags'])
+    return rows, time.time() - start
+
+def time_tuple_rows(file_in):
+    """Same as time_dict_rows() with the tuple rows used by process_map()"""
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        writers = [UnicodeWriter(devnull, fields) for path, fields in CSV_OUTPUTS]
+        write_elements(get_element(file_in, tags=('node', 'way')), False, writers)
+    return time.time() - start
+
+rows, dict_seconds = time_dict_rows(sample_file)
+tuple_seconds = time_tuple_rows(sample_file)
+print "dict rows:  %d rows/sec" % (rows / dict_seconds)
+print "tuple rows: %d rows/sec" % (rows / tuple_seconds)
+
+element = next(get_element(sample_file, tags=('node',)))
+print "node row size in bytes, dict vs. tuple:",     sys.getsizeof(shape_element(element)['node']), sys.getsizeof(shape_rows(element)[0])
+
+
+# In[ ]:
+
+# Parser backends compared in elements/sec, parsing and shaping every element
+# of the sample file and of a synthetic file holding 20 copies of its elements
+def time_parser(file_in, parser):
+    """Return elements/sec of get_element() + shape_rows() with the given backend"""
+    count = 0
+    start = time.time()
+    for element in get_element(file_in, parser=parser):
+        shape_rows(element)
+        count += 1
+    return count / (time.time() - start)
+
+scaled_file = "scaled_osm"
+write_scaled_osm(sample_file, scaled_file, 20)
+
+parsers = [parser for parser in sorted(XML_PARSERS) if parser != 'lxml' or lxml_etree is not None]
+for file_in in (sample_file, scaled_file):
+    for parser in parsers:
+        print "%-10s %-6s %d elements/sec" % (file_in, parser, time_parser(file_in, parser))
+os.remove(scaled_file)
+
+
+# In[ ]:
+
+# Output throughput of the three write patterns: a write() per element or
+# row straight to the file, writes gathered into OUTPUT_BUFFER chunks, and
+# chunks written by a BackgroundWriter thread while the next ones are made.
+# It writes the sample's elements 20 times over and exports the sample to CSV
+# three times, so it only runs when asked for.
+WRITE_BENCHMARK = False
+WRITE_BENCHMARK_COPIES = 20
+WRITE_PATTERNS = [('per write', None, False), ('buffered', OUTPUT_BUFFER, False),
+                  ('background', OUTPUT_BUFFER, True)]
+
+def time_element_writes(pieces, copies, path, buffer_size, background):
+    """Return MB/sec of writing the serialized elements in pieces copies times over to path"""
+    start = time.time()
+    if buffer_size is None:
+        output = open(path, 'wb')
+        writer = None
+    else:
+        writer = BackgroundWriter() if background else None
+        output = BufferedOutput(open(path, 'wb'), buffer_size, writer)
+    for i in range(copies):
+        for piece in pieces:
+            output.write(piece)
+    output.close()
+    if writer is not None:
+        writer.close()
+    seconds = time.time() - start
+    os.remove(path)
+    return copies * sum(map(len, pieces)) / seconds / 1024 ** 2
+
+def time_csv_writes(file_in, buffer_size, background):
+    """Return elements/sec of parsing, shaping and writing file_in to CSV files"""
+    count = [0]
+
+    def counted(elements):
+        for element in elements:
+            count[0] += 1
+            yield element
+
+    start = time.time()
+    write_csvs(counted(get_element(file_in)), False, '.bench', True,
+               buffer_size=buffer_size, background=background)
+    seconds = time.time() - start
+    for path, fields in CSV_OUTPUTS:
+        os.remove(path + '.bench')
+    return count[0] / seconds
+
+if __name__ == '__main__' and WRITE_BENCHMARK:
+    pieces = [ET.tostring(element, encoding='utf-8') for element in get_element(sample_file)]
+    for label, buffer_size, background in WRITE_PATTERNS:
+        print "%-10s %6.1f MB/sec writing elements" % (label, time_element_writes(
+            pieces, WRITE_BENCHMARK_COPIES, "bench_osm", buffer_size, background))
+    del pieces
+    for label, buffer_size, background in WRITE_PATTERNS:
+        print "%-10s %d elements/sec to CSV" % (label, time_csv_writes(sample_file, buffer_size, background))
 
 
 # In[14]:
@@ -592,13 +3654,18 @@ if __name__ == '__main__':
 # CSV files' sizes
 print "The full OpenStreetMap file is", file_size(osm_file)
 print "while its sample file size is", file_size(sample_file), ","
-print "for records systematically selected every", k, "th (top) row."
+print "for ways systematically selected every", k, "th way, with the nodes they use."
 print ""
 print "Nodes.csv file size:", file_size(NODES_PATH)
 print "Nodes_tags.csv file size:", file_size(NODE_TAGS_PATH)
 print "Ways.csv file size:", file_size(WAYS_PATH)
 print "Ways_nodes.csv file size:", file_size(WAY_NODES_PATH)
 print "Ways_tags.csv file size:", file_size(WAY_TAGS_PATH)
+print "Relations.csv file size:", file_size(RELATIONS_PATH)
+print "Relation_members.csv file size:", file_size(RELATION_MEMBERS_PATH)
+print "Relation_tags.csv file size:", file_size(RELATION_TAGS_PATH)
+for path in COLUMNAR_PATHS:
+    print path, "file size:", file_size(path)
 
 
 # ##### Database table building based on extracted CSV files
@@ -609,7 +3676,7 @@ print "Ways_tags.csv file size:", file_size(WAY_TAGS_PATH)
 # where sql-based tables will be stored 
 import sqlite3
 
-conn = sqlite3.connect("irvingtx.db")
+conn = sqlite3.connect(DB_PATH)
 q = conn.cursor()
 
 
@@ -617,11 +3684,44 @@ q = conn.cursor()
 
 ### Removing tables, if already created, for run all
 # https://stackoverflow.com/questions/1601151/how-do-i-check-in-sqlite-whether-a-table-exists?rq=1
-q.execute("DROP table IF EXISTS nodes"); conn.commit()
-q.execute("DROP table IF EXISTS nodes_tags"); conn.commit()
-q.execute("DROP table IF EXISTS ways"); conn.commit()
-q.execute("DROP table IF EXISTS ways_nodes"); conn.commit()
-q.execute("DROP table IF EXISTS ways_tags"); conn.commit()
+# The tables are dropped and recreated by build_database() below.
+
+def read_csv_rows(path, fields):
+    """Yield the rows of a CSV file as tuples of utf-8 decoded values, in fields order"""
+    with open(path, 'rb') as fin:
+        for row in csv.DictReader(fin):
+            yield tuple(row[field].decode("utf-8") for field in fields)
+
+def build_database(conn, tuned=True, indexed=False):
+    """Create the five tables and fill them from the CSV files
+
+    tuned=True loads everything in one transaction under the bulk-load
+    profile (see begin_bulk_load), builds the indexes afterwards and runs
+    ANALYZE. tuned=False is the original recipe: default settings, a
+    commit after every DROP, CREATE and table load, and no SQL_INDEXES.
+    indexed=True adds those to the original recipe, created before the
+    load so they are filled row by row.
+    """
+    if tuned:
+        begin_bulk_load(conn)
+    else:
+        for table, fields, create in SQL_TABLES:
+            conn.execute("DROP TABLE IF EXISTS {0}".format(table)); conn.commit()
+            conn.execute(create); conn.commit()
+        if indexed:
+            for index in SQL_INDEXES:
+                conn.execute(index); conn.commit()
+
+    for (path, fields), (table, _, _) in zip(CSV_OUTPUTS, SQL_TABLES):
+        conn.executemany(insert_sql(table, fields), read_csv_rows(path, fields))
+        if not tuned:
+            conn.commit()
+
+    if tuned:
+        end_bulk_load(conn)
+    else:
+        build_spatial_index(conn); conn.commit()
+        build_way_geometry(conn); conn.commit()
 
 
 # **UTF? Text Coding Problem**: Due to text compatibility issue, text variables need to be converted utf-8.
@@ -657,88 +3757,86 @@ q.execute("DROP table IF EXISTS ways_tags"); conn.commit()
 # 
 # ##### Creating Query'able Tables
 # For each table, we assign the appropiate formats so that queries, subqueries, joins, etc. can be performed on these tables. After creating a table, I inserted data from the created CSV files from *shape_element()* .
+# 
+# The rows are streamed from each CSV file straight into *executemany()* rather than collected into a *to_db* list first. The whole build runs as one transaction with journaling and syncing relaxed, and the indexes are built after the data is in.
 
 # In[17]:
 
-### 1. Creating nodes TABLE 
-q.execute("    CREATE TABLE nodes         (         id INTEGER PRIMARY KEY NOT NULL,         lat REAL, lon REAL,        user TEXT,         uid INTEGER,         version INTEGER,         changeset INTEGER,         timestamp TEXT)     ")
-
-### Prepping data as a list of tupes
-with open('nodes.csv','rb') as fin:
-    dr = csv.DictReader(fin) 
-    to_db = [(i['id'], i['lat'], i['lon'], i['user'].decode("utf-8"), i['uid'], i['version'], i['changeset'], i['timestamp'])              for i in dr]
-
-### Reading data into table
-q.executemany("INSERT INTO nodes (id, lat, lon, user, uid, version, changeset, timestamp)                 VALUES (?, ?, ?, ?, ?, ?, ?, ?);", to_db)
-conn.commit()
-
-
-# In[18]:
-
-### 2. Creating nodes_tags table
-#    q.execute('''DROP TABLE nodes_tags''')
-
-q.execute("    CREATE TABLE nodes_tags         (         id INTEGER,         key TEXT,        value TEXT,         type TEXT,         FOREIGN KEY (id) REFERENCES nodes (id))     ")
-conn.commit()
-
-### Prepping data as a list of tuples
-with open('nodes_tags.csv','rb') as fin:
-    dr = csv.DictReader(fin) 
-    to_db = [(i['id'], i['key'].decode("utf-8"),i['value'].decode("utf-8"),               i['type'].decode("utf-8"))              for i in dr]
-
-### Reading data into table
-q.executemany("INSERT INTO nodes_tags (id, key, value, type)                 VALUES (?, ?, ?, ?);", to_db)
-conn.commit()
-
-
-# In[19]:
-
-### 3. Creating ways table
-
-q.execute("     CREATE table ways         (         id INTEGER PRIMARY KEY,         user TEXT,         uid INTEGER,         version INTEGER,         changeset TEXT,         timestamp TEXT)     ")
-conn.commit()
-
-### Prepping data as a list of tuples
-with open('ways.csv','rb') as fin:
-    dr = csv.DictReader(fin)
-    to_db = [(i['id'], i['user'].decode("utf-8"), i['uid'], i['version'],               i['changeset'].decode("utf-8"), i['timestamp'] )             for i in dr]
-    
-### Reading data into table
-q.executemany("INSERT into ways (id, user, uid, version, changeset, timestamp )             VALUES (?,?,?,?,?,?) ;",             to_db)
-conn.commit()
-
-
-# In[20]:
-
-### 4. Create ways_nodes table
-q.execute("     CREATE table ways_nodes (     id INTEGER,     node_id INTEGER,     position INTEGER,     FOREIGN KEY (id) REFERENCES ways (id),     FOREIGN KEY (node_id) REFERENCES nodes (id))     ")
-conn.commit()
-
-### Prepping data as a list of tuples
-with open ('ways_nodes.csv','rb') as fin:
-    dr = csv.DictReader(fin)
-    to_db = [(i['id'], i['node_id'], i['position']) for i in dr]
-    
-### Reading data into table
-q.executemany("INSERT into ways_nodes (id, node_id, position) VALUES (?,?,?) ;", to_db)
-conn.commit()
-
-
-# In[21]:
-
-### 5. Create ways_tags table
-# q.execute("CREATE table IF NOT EXISTS ways_tags
-q.execute("CREATE table ways_tags     (         id INTEGER,         key TEXT,         value TEXT,         type TEXT,         FOREIGN KEY (id) REFERENCES ways(id))     ")
-conn.commit()
-
-### Prepping data as a list of tuples
-with open('ways_tags.csv','rb') as fin:
-    dr = csv.DictReader(fin)
-    to_db = [(i['id'], i['key'].decode("utf-8"), i['value'].decode("utf-8"), i['type'].decode("utf-8"))              for i in dr]
-
-### Reading data into table
-q.executemany("INSERT into ways_tags (id,key,value,type)             VALUES(?,?,?,?);"               , to_db)
-conn.commit()
+### Creating and filling the nodes, nodes_tags, ways, ways_nodes and ways_tags tables
+# The tables are rebuilt whenever the CSV files, the table definitions or the
+# loading code changed, however old the database file itself is.
+# connect() above has already created DB_PATH if it was missing, so the file
+# existing proves nothing: the tables themselves have to be there.
+db_inputs = {'csv': [build_manifest.file_digest(path) for path in CSV_PATHS],
+             'schema': value_digest([SQL_TABLES, SQL_INDEXES, NODES_RTREE, WAY_GEOMETRY_TABLE]),
+             'code': code_digest([build_database, read_csv_rows, begin_bulk_load, end_bulk_load,
+                                  build_spatial_index, build_way_geometry, way_geometry_row,
+                                  is_area, node_location_store, NodeLocationArray,
+                                  SparseNodeLocations, DenseNodeLocations])}
+if (build_manifest.stale('db', db_inputs, [DB_PATH])
+        or not all(table_exists(conn, table) for table, fields, create in SQL_TABLES)):
+    build_database(conn)
+    build_manifest.record('db', db_inputs)
+
+
+# In[ ]:
+
+### Load time: the original table-by-table commits vs. the bulk-load profile
+# The original recipe had no indexes; the second case adds SQL_INDEXES to it,
+# created before the load as they would be in the original style
+for label, tuned, indexed in [("Default settings", False, False),
+                              ("Default settings, indexes first", False, True),
+                              ("Bulk-load profile, indexes after", True, False)]:
+    bench = sqlite3.connect("benchmark.db")
+    start = time.time()
+    build_database(bench, tuned=tuned, indexed=indexed)
+    print label, "load time:", round(time.time() - start, 2), "seconds"
+    bench.close()
+    os.remove("benchmark.db")
+
+
+# In[ ]:
+
+### Node location stores: bytes per node and lookups per second
+# The nodes are renumbered 1..n in id order, the way a planet file nearly
+# fills its id range, so the dense file is not sized by this extract's
+# scattered ids. The lookups are the node refs of ways_nodes found in nodes,
+# in random order.
+node_rows = conn.execute("SELECT id, lat, lon FROM nodes \
+    WHERE lat IS NOT NULL AND lon IS NOT NULL ORDER BY id").fetchall()
+renumbered = dict((row[0], i) for i, row in enumerate(node_rows, 1))
+lookups = [renumbered[node_id] for node_id, in
+           conn.execute("SELECT node_id FROM ways_nodes LIMIT 200000") if node_id in renumbered]
+random.shuffle(lookups)
+
+for name in ('array', 'sparse', 'dense'):
+    store = NODE_STORES[name]()
+    for i, (node_id, lat, lon) in enumerate(node_rows, 1):
+        store.add(i, lat, lon)
+    start = time.time()
+    for node_id in lookups:
+        store.get(node_id)
+    seconds = time.time() - start
+    print "%-6s %5.1f bytes/node %9d lookups/sec" % (
+        name, float(store.nbytes()) / max(len(node_rows), 1), len(lookups) / max(seconds, 1e-9))
+    store.close()
+
+max_node_id = node_rows[-1][0] if node_rows else 0
+store = node_location_store(len(node_rows), max_node_id)
+print "Store picked for", len(node_rows), "nodes with ids up to", max_node_id, ":", type(store).__name__
+store.close()
+
+
+# ##### Daily Updates
+# Rather than dropping and rebuilding every table to pick up a day's edits, the daily OsmChange diff and its replication state file can be applied to the existing database.
+
+# In[ ]:
+
+OSC_PATH = "irving-daily.osc.gz"
+OSC_STATE_PATH = "irving-daily.state.txt"
+
+if os.path.exists(OSC_PATH):
+    print apply_osc(OSC_PATH, DB_PATH, read_replication_state(OSC_STATE_PATH))
 
 
 # ##### Tables Created
@@ -814,6 +3912,14 @@ q.execute("SELECT COUNT(*) FROM ways_tags;")
 print "Number of ways tags:", q.fetchone()[0]
 
 
+# In[ ]:
+
+q.execute("SELECT COUNT(*) FROM relations;")
+print "Number of relations:", q.fetchone()[0]
+q.execute("SELECT COUNT(*) FROM relation_members;")
+print "Number of relation members:", q.fetchone()[0]
+
+
 # ### Other Statistics
 
 # #### Data table size, users (distinct) count, top 10 contributors, top ameneties, 
@@ -882,7 +3988,8 @@ print pandas.read_sql_query("    SELECT key,COUNT(*) as num     FROM nodes_tags
 # In[39]:
 
 # Amenities
-print pandas.read_sql_query("SELECT value, COUNT(*) as NumAm     FROM nodes_tags     WHERE key='amenity'     GROUP BY value     ORDER BY NumAm DESC     LIMIT 15     ;", conn)
+amenity_query = "SELECT value, COUNT(*) as NumAm     FROM nodes_tags     WHERE key='amenity'     GROUP BY value     ORDER BY NumAm DESC     LIMIT 15     ;"
+print pandas.read_sql_query(amenity_query, conn)
 
 
 # Food ameneties with _burger_ as their food types has the most amenity (9), followed by sandwich (6). This is consistent with I expected from a Dallas suburb city. 
@@ -890,7 +3997,8 @@ print pandas.read_sql_query("SELECT value, COUNT(*) as NumAm     FROM nodes_tags
 # In[40]:
 
 # Amenities: Food
-print pandas.read_sql_query("SELECT nodes_tags.value, COUNT(*) as num            FROM nodes_tags                JOIN (SELECT DISTINCT(id)                FROM nodes_tags                WHERE value in ('restaurant','fast_food','cafe')) food               ON nodes_tags.id = food.id            WHERE nodes_tags.key = 'cuisine'           GROUP BY nodes_tags.value           ORDER BY num DESC     ;", conn)
+food_query = "SELECT nodes_tags.value, COUNT(*) as num            FROM nodes_tags                JOIN (SELECT DISTINCT(id)                FROM nodes_tags                WHERE value in ('restaurant','fast_food','cafe')) food               ON nodes_tags.id = food.id            WHERE nodes_tags.key = 'cuisine'           GROUP BY nodes_tags.value           ORDER BY num DESC     ;"
+print pandas.read_sql_query(food_query, conn)
 
 
 # #### Residence
@@ -900,13 +4008,15 @@ print pandas.read_sql_query("SELECT nodes_tags.value, COUNT(*) as num
 # In[41]:
 
 # nodes_tags table composition
-print pandas.read_sql_query("    SELECT key, count(*)      FROM nodes_tags     WHERE type in ('addr')     GROUP BY key     ;", conn)
+addr_query = "    SELECT key, count(*)      FROM nodes_tags     WHERE type in ('addr')     GROUP BY key     ;"
+print pandas.read_sql_query(addr_query, conn)
 
 
 # In[42]:
 
 # Most Street Names
-print pandas.read_sql_query("    SELECT value,count(*) as freq     FROM nodes_tags     WHERE key in ('street')    GROUP BY value ORDER BY freq DESC    LIMIT 10     ;", conn)
+street_query = "    SELECT value,count(*) as freq     FROM nodes_tags     WHERE key in ('street')    GROUP BY value ORDER BY freq DESC    LIMIT 10     ;"
+print pandas.read_sql_query(street_query, conn)
 
 
 # Here I found more evidence on contributors not being too concerned about residential units. North Macarthus Boulevard is definitely a major road with many housing units. The housing units should be way more than 120 let alone 12!!!
@@ -927,7 +4037,67 @@ print pandas.read_sql_query("    SELECT value,count(*) as freq     FROM nodes_ta
 
 # In[43]:
 
-print pandas.read_sql_query("SELECT user, count(*) as ucount FROM     (SELECT nodes_tags.id, nodes.* FROM nodes_tags     INNER JOIN nodes     ON nodes_tags.id=nodes.id     WHERE key in ('street')) GROUP BY user ORDER BY ucount DESC LIMIT 10    ;", conn)
+street_users_query = "SELECT user, count(*) as ucount FROM     (SELECT nodes_tags.id, nodes.* FROM nodes_tags     INNER JOIN nodes     ON nodes_tags.id=nodes.id     WHERE key in ('street')) GROUP BY user ORDER BY ucount DESC LIMIT 10    ;"
+print pandas.read_sql_query(street_users_query, conn)
+
+
+# #### Road Lengths
+# 
+# way_geometry already holds every way's length, so kilometres of road by highway type come from one pass over the highway tags.
+
+# In[ ]:
+
+highway_length_query = "SELECT t.value AS highway, COUNT(*) AS ways,     ROUND(SUM(g.length) / 1000, 1) AS km     FROM ways_tags t JOIN way_geometry g ON g.id = t.id     WHERE t.type = 'regular' AND t.key = 'highway'     GROUP BY t.value ORDER BY km DESC     LIMIT 15     ;"
+print pandas.read_sql_query(highway_length_query, conn)
+
+
+# In[ ]:
+
+### Checking that every report query above is served by an index
+def query_plan(conn, query):
+    """Return the detail column of EXPLAIN QUERY PLAN for query"""
+    return [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + query)]
+
+# Every SCAN of a table reads all of its rows, even "SCAN t USING INDEX i",
+# which only walks them in index order; an index serves a query only in a
+# SEARCH step. Scans of subquery results (MATERIALIZE/CO-ROUTINE) are fine.
+PLAN_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+PLAN_SUBQUERY = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (?:\d+ )?(\w+)')
+
+def full_scans(conn, query):
+    """Plan steps that read every row of a table"""
+    plan = query_plan(conn, query)
+    subqueries = set(m.group(1) for m in map(PLAN_SUBQUERY.match, plan) if m)
+    return [step for step in plan
+            if PLAN_SCAN.match(step) and PLAN_SCAN.match(step).group(1) not in subqueries]
+
+report_queries = {"amenity": amenity_query, "food": food_query, "addr": addr_query,
+                  "street": street_query, "street users": street_users_query,
+                  "highway length": highway_length_query}
+for name, query in sorted(report_queries.items()):
+    print name, query_plan(conn, query)
+    assert not full_scans(conn, query), "%s query does a full table scan" % name
+
+
+# #### Around the House
+# 
+# The counts above say what the area has, not what is near a given address. With the nodes_rtree spatial index the eating places around a house, or the nearest ones, come back in milliseconds.
+
+# In[ ]:
+
+house = (32.8140, -96.9489)  # lat, lon of the house
+eating_out = ['restaurant', 'fast_food', 'cafe']
+
+start = time.time()
+nearby = nodes_within(conn, house[0], house[1], 1000, key='amenity', value=eating_out)
+print len(nearby), "eating places within 1 km (%.1f ms)" % ((time.time() - start) * 1000)
+
+start = time.time()
+nearest = nearest_nodes(conn, house[0], house[1], 5, key='amenity', value=eating_out)
+print "5 nearest (%.1f ms):" % ((time.time() - start) * 1000)
+for metres, node_id, lat, lon in nearest:
+    name = conn.execute("SELECT value FROM nodes_tags WHERE id = ? AND key = 'name'", (node_id,)).fetchone()
+    print "  %4d m  %s" % (metres, name[0] if name else node_id)
 
 
 # **Legit Data?**